@@ -1,12 +1,15 @@
 from collections import UserDict
+from datetime import date
+from itertools import islice
 from datetime import datetime
-from pickle import dump, load
 from abc import abstractmethod, ABC
-from re import search
+import re
+from journal import Journal, JournalBook, Records
+from metrics import METRICS, timed
+from indexes import TrigramIndex, BKTree, HashIndex, BirthdayIndex, SortedKeys, next_birthday, \
+    normalize_key
 
 class Target(ABC):
-    pagination = None
-    
     @abstractmethod
     def add(self):
         """Adding record"""
@@ -32,17 +35,36 @@ class Target(ABC):
         """Iteration by records"""
 
 class Field:
+    __slots__ = ("required", "_value")
+
     def __init__(self, value, required=False):
         self.required = required
         self._value = None
         self.value = value
 
+    @classmethod
+    def from_value(cls, value, required=False):
+        """Builds field from already validated value"""
+        field = cls.__new__(cls)
+        field.required = required
+        field._value = value
+        return field
+
+    def __setstate__(self, state):
+        # fields pickled before __slots__ keep their state in a dict
+        if isinstance(state, tuple):
+            state = state[1]
+        for key, value in state.items():
+            setattr(self, key, value)
+
     @property
     def value(self):
         return self._value
     
 
 class Name(Field):
+    __slots__ = ()
+
     @Field.value.setter
     def value(self, new_value: str):
         if self.required and not new_value:
@@ -51,6 +73,8 @@ class Name(Field):
             self._value = new_value
 
 class Phone(Field):
+    __slots__ = ()
+
     @Field.value.setter
     def value(self, new_value):
         if self.is_valid_phone(new_value):
@@ -66,7 +90,10 @@ class Phone(Field):
         return is_valid
 
 class Birthday(Field):
+    __slots__ = ()
     DATE_FORMAT = "%d.%m.%Y"
+    # dates before this year can not be in the future, no need to ask the clock
+    PAST_YEAR = date.today().year
 
     def __str__(self):
         if self.value:
@@ -74,15 +101,26 @@ class Birthday(Field):
         else:
             return ""
 
+    @staticmethod
+    def parse(text: str) -> date:
+        # fast path for dd.mm.YYYY, anything else goes to strptime
+        if len(text) == 10 and text[2] == "." and text[5] == "." \
+                and text[:2].isdigit() and text[3:5].isdigit() and text[6:].isdigit():
+            return date(int(text[6:]), int(text[3:5]), int(text[:2]))
+        return datetime.strptime(text, Birthday.DATE_FORMAT).date()
+
     @Field.value.setter
     def value(self, new_value: str):
-        date_value = datetime.strptime(new_value, self.DATE_FORMAT).date()
-        if date_value > datetime.now().date():
+        date_value = self.parse(new_value)
+        if date_value.year >= self.PAST_YEAR and date_value > date.today():
             raise ValueError("Date of birth can not be in the future!")
         else:
             self._value = date_value
 
 class Email(Field):
+    __slots__ = ()
+    PATTERN = re.compile(r"^[\w+\.]+@([\w-]+\.)+[\w+]{2,4}$")
+
     def __str__(self):
         if self.value is None:
             return ""
@@ -91,13 +129,16 @@ class Email(Field):
 
     @Field.value.setter
     def value(self, new_value: str):
-        if search(r"^[\w+\.]+@([\w-]+\.)+[\w+]{2,4}$", new_value):
+        if self.PATTERN.search(new_value):
             self._value = new_value
         else:
             raise ValueError("Give me correct email")
 
 class Record:
+    __slots__ = ("name", "phones", "birthday", "email", "book")
+
     def __init__(self, name: Name, phone: Phone=None, birthday: Birthday=None, email: Email=None):
+        self.book = None  # AddressBook the record belongs to
         self.name = name
         self.phones = []
         self.add_phone(phone)
@@ -111,6 +152,49 @@ class Record:
                         f"phones: {'; '.join(p.value for p in self.phones)}, "\
                         f"birthday: {self.birthday if self.birthday else ''}"\
                         f"email: {self.email}"
+
+    def __getstate__(self):
+        return {key: getattr(self, key) for key in self.__slots__ if key != "book"}
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state = state[1]
+        self.book = None
+        for key, value in state.items():
+            if key != "book":
+                setattr(self, key, value)
+
+    def changing(self) -> None:
+        # called before a change, so the book knows what the record was
+        if self.book is not None:
+            self.book.record_changing(self)
+
+    def changed(self) -> None:
+        if self.book is not None:
+            self.book.record_changed(self)
+
+    def check_phones(self, phones: [str]) -> None:
+        if self.book is not None:
+            self.book.check_phones(self.name.value, phones)
+
+    def search_texts(self) -> [str]:
+        texts = [self.name.value]
+        texts.extend(p.value for p in self.phones)
+        if self.email:
+            texts.append(self.email.value)
+        if self.birthday:
+            texts.append(str(self.birthday))
+        return texts
+
+    def search_key(self) -> str:
+        """Normalized search texts in one string, searched instead of the fields"""
+        return normalize_key("\n".join(self.search_texts()))
+
+    def matches(self, search: str) -> bool:
+        for text in self.search_texts():
+            if search in text:
+                return True
+        return False
         
     def find_phone(self, value: str, strict=True) -> Phone:
         result = None
@@ -125,12 +209,17 @@ class Record:
 
     def add_phone(self, phone: Phone) -> None:
         if phone:
+            self.check_phones([phone.value])
+            self.changing()
             self.phones.append(phone)
+            self.changed()
         
     def remove_phone(self, value: str) -> None:
         phone = self.find_phone(value)
         if phone:
+            self.changing()
             self.phones.remove(phone)
+            self.changed()
         else:
             raise ValueError("Phone doesn't exist")
         
@@ -138,23 +227,24 @@ class Record:
     def edit_phone(self, old_value: str, new_value: str) -> None:
         phone = self.find_phone(old_value)
         if phone:
+            self.check_phones([new_value])
+            self.changing()
             phone.value = new_value
+            self.changed()
         else:
             raise ValueError("Phone doesn't exist")
     
     def add_birthday(self, birthday: Birthday):
         if birthday:
+            self.changing()
             self.birthday = birthday
+            self.changed()
 
-    def days_to_birthday(self) -> int:
+    def days_to_birthday(self, today=None) -> int:
         if self.birthday:
-            cur_date = datetime.now().date()
-            
-            new_birthday = self.birthday.value
-            new_birthday = new_birthday.replace(year=cur_date.year)
-            
-            if new_birthday < cur_date:
-                new_birthday = new_birthday.replace(year=cur_date.year+1)
+            cur_date = today if today else datetime.now().date()
+            birthday = self.birthday.value
+            new_birthday = next_birthday(birthday.month, birthday.day, cur_date)
             
             delta = new_birthday - cur_date
             
@@ -162,32 +252,142 @@ class Record:
         
     def add_email(self, email: Email):
         if email:
+            self.changing()
             self.email = email
+            self.changed()
 
 class Pagination:
     DEFAULT_PER_PAGE = 3
 
-    def __init__(self, records: list, records_per_page=None):
+    def __init__(self, source, count, records_per_page=None):
+        """
+        source(cursor) gives (cursor, record) pairs following the cursor,
+        count() gives the number of records
+        """
         self.curent_page = 1
         self.records_per_page = records_per_page if records_per_page else self.DEFAULT_PER_PAGE
-        self.records = records
-        self.pages_count = (len(self.records) - 1) // self.records_per_page + 1
+        self.source = source
+        self.count = count
+        self.cursor = None  # last record shown
+
+    @classmethod
+    def from_list(cls, records: list, records_per_page=None):
+        def source(cursor):
+            start = 0 if cursor is None else cursor + 1
+            for i in range(start, len(records)):
+                yield i, records[i]
+        return cls(source, records.__len__, records_per_page)
+
+    @classmethod
+    def from_keys(cls, keys: list, get, records_per_page=None):
+        """
+        Pages of get(key) for the keys, records are read only for the shown
+        pages. Keys get() gives None for, deleted meanwhile, are skipped
+        """
+        def source(cursor):
+            start = 0 if cursor is None else cursor + 1
+            for i in range(start, len(keys)):
+                record = get(keys[i])
+                if record is not None:
+                    yield i, record
+        return cls(source, keys.__len__, records_per_page)
+
+    @property
+    def pages_count(self):
+        return (self.count() - 1) // self.records_per_page + 1
 
+    @timed()
     def __next__(self):
-        if self.curent_page <= self.pages_count:
-            start = (self.curent_page - 1) * self.records_per_page
-            stop = start + self.records_per_page
-            page = ""
-            for record in self.records[start: stop]:
-                page += str(record) + "\n"
-            page += f"Page {self.curent_page} of {self.pages_count}"
-            self.curent_page += 1
-            
-            return page
-        raise StopIteration
+        # only records of the requested page are read and rendered
+        records = list(islice(self.source(self.cursor), self.records_per_page))
+        if not records:
+            raise StopIteration
+        self.cursor = records[-1][0]
+        page = [str(record) for cursor, record in records]
+        page.append(f"Page {self.curent_page} of {max(self.curent_page, self.pages_count)}")
+        self.curent_page += 1
+        
+        return "\n".join(page)
+
+def fuzzy_terms(name: str) -> set:
+    """Words of the name compared with typo tolerant queries"""
+    return set(normalize_key(name).split())
+
+
+def fuzzy_distance(word: str) -> int:
+    """How many typos a query word of this length may have"""
+    if len(word) <= 2:
+        return 0
+    return 1 if len(word) <= 8 else 2
+
+
+def fuzzy_search(index: BKTree, search: str, max_distance: int = None) -> [(int, str)]:
+    """
+    Keys having a close name word for every word of search,
+    fewest typos in total first
+    """
+    found = None
+    for word in normalize_key(search).split():
+        distance = fuzzy_distance(word) if max_distance is None else max_distance
+        close = {key: typos for typos, key in index.search(word, distance)}
+        if found is None:
+            found = close
+        else:
+            found = {key: found[key] + typos for key, typos in close.items() if key in found}
+        if not found:
+            return []
+    return sorted((typos, key) for key, typos in (found or {}).items())
 
-class AddressBook(UserDict):
-    def __init__(self, file_name: str = None):
+
+def record_meta(record: Record, search_key: str = None) -> tuple:
+    """What indexes need of a record: search key, phones, email key and birthday ordinal"""
+    return (search_key or record.search_key(), tuple(p.value for p in record.phones),
+            normalize_key(record.email.value) if record.email else None,
+            record.birthday.value.toordinal() if record.birthday else None)
+
+
+def record_fields(record: Record) -> tuple:
+    """Values of the fields a contact is merged by: phones, email and birthday"""
+    return (tuple(p.value for p in record.phones), record.email.value if record.email else None,
+            record.birthday.value if record.birthday else None)
+
+
+def merge_record(base: tuple, ours: Record, theirs: Record) -> Record:
+    """
+    Three-way merge of a contact changed here and in another process, base is
+    record_fields() of it before the change here. Each field is taken from
+    the side that changed it, phones one by one
+    """
+    base_phones, base_email, base_birthday = base or ((), None, None)
+    phones, email, birthday = record_fields(ours)
+    their_phones, their_email, their_birthday = record_fields(theirs)
+    for base_value, value, their_value in ((base_email, email, their_email),
+                                           (base_birthday, birthday, their_birthday)):
+        if value != base_value and their_value not in (base_value, value):
+            raise ValueError("Changed on both sides")
+    if email != base_email:
+        theirs.email = ours.email
+    if birthday != base_birthday:
+        theirs.birthday = ours.birthday
+    removed = set(base_phones) - set(phones)
+    theirs.phones = [p for p in theirs.phones if p.value not in removed] + \
+        [p for p in ours.phones if p.value not in base_phones and p.value not in their_phones]
+    return theirs
+
+
+class AddressBook(JournalBook, UserDict):
+    KIND = "Contacts"
+
+    def __init__(self, file_name: str = None, unique_phones: bool = False):
+        self.journal = None
+        self.search_index = TrigramIndex()
+        self.search_keys = {}  # name -> Record.search_key()
+        self.name_index = HashIndex()  # normalized name -> names
+        self.fuzzy_index = None  # built from names on first fuzzy search
+        self.phone_index = HashIndex(unique=unique_phones)
+        self.email_index = HashIndex()
+        self.birthday_index = BirthdayIndex()
+        self.keys_index = SortedKeys()
         self.__file_name = None
         self.file_name = file_name
 
@@ -198,47 +398,161 @@ class AddressBook(UserDict):
     @file_name.setter
     def file_name(self, file_name:str):
         self.__file_name = file_name
+        self.journal = Journal(file_name, dump_meta=self.stored_meta) if file_name else None
         self.restore()
     
     def add(self, record: Record) -> None:
-        if record.name.value in self.data:
+        if record.name.value in self.data or self.name_index.get(normalize_key(record.name.value)):
             raise ValueError(f"Record with name {record.name.value} is already exists")
+        self.check_phones(record.name.value, [p.value for p in record.phones])
         self.data[record.name.value] = record
+        self.keys_index.add(record.name.value)
+        record.book = self
+        self.record_changed(record)
         self.save()
     
-    def delete(self, name: str) -> Record:
+    def resolve(self, name: str) -> str:
+        """
+        Name the record is stored under: the name itself or
+        the only name with the same normalized key, None if there is none
+        """
         if name in self.data:
-            self.data.pop(name)
+            return name
+        names = self.name_index.get(normalize_key(name))
+        if len(names) == 1:
+            return next(iter(names))
+        return None
+
+    def __contains__(self, name) -> bool:
+        return self.resolve(name) is not None
+
+    def __missing__(self, name):
+        resolved = self.resolve(name)
+        if resolved is None:
+            raise KeyError(name)
+        return self.data[resolved]
+
+    def delete(self, name: str) -> Record:
+        name = self.resolve(name)
+        if name is not None:
+            record = self.data.pop(name)
+            self.record_changing(record)
+            record.book = None
+            self.keys_index.remove(name)
+            self.unindex(name)
+            self.mark_dirty(name)
             self.save()
             return True
         
 
-    def find(self, search: str) -> Record:
-        records = []
-        for name, record in self.data.items():
-            pos = name.find(search)
-            if pos != -1:
-                records.append(record)
-            elif record.find_phone(search, strict=False):
-                records.append(record)
-            elif search in record.email:
-                records.append(record)
-            elif search in str(record.birthday):
-                records.append(record)
-
-        return records
+    def find(self, search: str) -> [Record]:
+        return [self.data[name] for name in self.find_names(search)]
+
+    @timed()
+    def find_names(self, search: str) -> [str]:
+        """Names of matching records, the records themselves are not read"""
+        search = normalize_key(search)
+        names = self.search_index.candidates(search)
+        if names is None:
+            names = self.data.keys()
+        else:
+            names = sorted(names)
+        METRICS.observe("AddressBook.find.scanned", len(names))
+        return [name for name in names if search in self.search_keys[name]]
+
+    @timed()
+    def find_fuzzy(self, search: str, max_distance: int = None) -> [Record]:
+        """Records whose name is a few typos away from search, closest first"""
+        if self.fuzzy_index is None:
+            self.fuzzy_index = BKTree()
+            for name in self.data:
+                self.fuzzy_index.add(name, fuzzy_terms(name))
+        return [self.data[name] for typos, name in fuzzy_search(self.fuzzy_index, search, max_distance)]
+
+    def find_by_phone(self, phone: str) -> [Record]:
+        return [self.data[name] for name in self.phone_index.get(phone)]
+
+    def find_by_email(self, email: str) -> [Record]:
+        return [self.data[name] for name in self.email_index.get(normalize_key(email))]
+
+    def upcoming_birthdays(self, days: int, today=None) -> [(int, Record)]:
+        # pairs of days left and record, nearest first
+        today = today if today else datetime.now().date()
+        upcoming = self.birthday_index.upcoming(today, days)
+        upcoming.sort()
+        return [(days_left, self.data[name]) for days_left, name in upcoming]
+
+    def days_to_birthday(self, name: str, today=None) -> int:
+        resolved = self.resolve(name)
+        if resolved is None:
+            raise KeyError(name)
+        today = today if today else datetime.now().date()
+        return self.birthday_index.days_to_birthday(resolved, today)
     
+    def records_after(self, name: str = None):
+        for name in self.keys_index.after(name):
+            yield name, self.data[name]
+
     def iterator(self, records_per_page=None):
-        records = [self.data[key] for key in self.data]
-        return Pagination(records, records_per_page)
+        return Pagination(self.records_after, self.data.__len__, records_per_page)
 
-    def save(self):
-        with open(self.file_name, "wb") as f:
-            dump(self.data, f)
+    def check_phones(self, name: str, phones: [str]) -> None:
+        self.phone_index.check(name, phones)
 
-    def restore(self):
-        try:
-            with open(self.file_name, "rb") as f:
-                self.data = load(f)
-        except:
-            self.data = {}
+    def record_changing(self, record: Record) -> None:
+        self.keep_base(record.name.value, record)
+
+    def fields(self, record: Record) -> tuple:
+        return record_fields(record)
+
+    def merge_fields(self, base: tuple, ours: Record, theirs: Record) -> Record:
+        return merge_record(base, ours, theirs)
+
+    def record_changed(self, record: Record) -> None:
+        self.value_changed(record.name.value, record)
+
+    def index(self, record: Record) -> None:
+        self.index_meta(record.name.value, record_meta(record))
+
+    def index_meta(self, name: str, meta: tuple) -> None:
+        search_key, phones, email, birthday = meta
+        old_key = self.search_keys.get(name)
+        self.search_keys[name] = search_key
+        # the stored search key tells which grams to drop, the index keeps none per name
+        self.search_index.add(name, [search_key], [old_key] if old_key is not None else ())
+        # the name is the first of the search texts
+        self.name_index.add(name, {search_key.partition("\n")[0]})
+        if self.fuzzy_index is not None:
+            self.fuzzy_index.add(name, fuzzy_terms(name))
+        self.phone_index.add(name, set(phones))
+        self.email_index.add(name, {email} if email is not None else set())
+        self.birthday_index.add(name, date.fromordinal(birthday) if birthday else None)
+
+    def stored_meta(self, record: Record) -> tuple:
+        # search keys of indexed records are up to date, they are not built again
+        return record_meta(record, self.search_keys.get(record.name.value))
+
+    def unindex(self, name: str) -> None:
+        search_key = self.search_keys.pop(name, None)
+        if search_key is not None:
+            self.search_index.remove(name, [search_key])
+        self.name_index.remove(name)
+        if self.fuzzy_index is not None:
+            self.fuzzy_index.remove(name)
+        self.phone_index.remove(name)
+        self.email_index.remove(name)
+        self.birthday_index.remove(name)
+
+    def rebuild(self, records: Records) -> None:
+        self.search_index.clear()
+        self.search_keys = {}
+        self.name_index.clear()
+        self.fuzzy_index = None
+        self.phone_index.clear()
+        self.email_index.clear()
+        self.birthday_index.clear()
+        # indexes are built from the snapshot directory, records are decoded when used
+        self.data = records
+        for name, meta in records.metas(record_meta):
+            self.index_meta(name, meta)
+        self.keys_index.reset(self.data)
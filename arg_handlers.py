@@ -4,31 +4,23 @@
 from pathlib import Path
 from abc import abstractmethod, ABC
 from address_book import *
+from metrics import timed
 
 class Handler(ABC):
     """
     Base handler class
     """
 
-    _next_handler = None
-
-    def set_next(self, handler):
-        self._next_handler = handler
-        
-        return handler
+    field = None  # argument name the handler validates
 
     @abstractmethod
-    def handle(self, request) -> str:
-        if self._next_handler:
-            return self._next_handler.handle(request)
-
-        return None
+    def validate(self, value):
+        """Checks one argument and converts it to what commands expect"""
 
 class NameHandler(Handler):
-    def handle(self, args):
-        if "name" not in args:
-            return super().handle(args)
-        name = args["name"]
+    field = "name"
+
+    def validate(self, name):
         if not name:
             raise ValueError("Give me name please")
         
@@ -36,10 +28,9 @@ class NameHandler(Handler):
         
 
 class BirthdayHandler(Handler):
-    def handle(self, args):
-        if "birthday" not in args:
-            return super().handle(args)
-        birthday = args["birthday"]
+    field = "birthday"
+
+    def validate(self, birthday):
         if birthday is None:
             raise ValueError("Giva me date of birth")
         
@@ -47,10 +38,9 @@ class BirthdayHandler(Handler):
         
 
 class PhoneHandler(Handler):
-    def handle(self, args):
-        if "phone" not in args:
-            return super().handle(args)
-        phone = args["phone"]
+    field = "phone"
+
+    def validate(self, phone):
         if phone is None:
             raise ValueError("Give me phone number")
         
@@ -58,10 +48,9 @@ class PhoneHandler(Handler):
 
 
 class EmailHandler(Handler):
-    def handle(self, args):
-        if "email" not in args:
-            return super().handle(args)
-        email = args["email"]
+    field = "email"
+
+    def validate(self, email):
         if email is None:
             raise ValueError("Give me email")
         
@@ -69,10 +58,9 @@ class EmailHandler(Handler):
     
     
 class TextHadnler(Handler):
-    def handle(self, args):
-        if "text" not in args:
-            return super().handle(args)
-        text = args["text"]
+    field = "text"
+
+    def validate(self, text):
         if not text:
             raise ValueError("Write your note here:")
         
@@ -80,10 +68,9 @@ class TextHadnler(Handler):
 
 
 class TagsHandler(Handler):
-    def handle(self, args):
-        if "tags" not in args:
-            return super().handle(args)
-        tags = args["tags"]
+    field = "tags"
+
+    def validate(self, tags):
         if not tags:
             raise ValueError("Enter your tags")
         
@@ -96,63 +83,175 @@ class TagsHandler(Handler):
 
 
 class FolderHandler(Handler):
-    def handle(self, args: dict):
-        if "folder" not in args:
-            return super().handle(args)
+    field = "folder"
 
-        path = args["folder"]
+    def validate(self, path):
         if path is None:
             raise ValueError("Give me a folder")
-        if not Path(path).exists():
+        if not Path(path).is_dir():
             raise ValueError("invalid path")
         return Path(path)
+
+class DryRunHandler(Handler):
+    field = "dry run"
+
+    def validate(self, dry_run):
+        if dry_run is None:
+            raise ValueError("Only show what would be moved?(Y/N)")
+        
+        return dry_run.lower() == "y"
+
+class DuplicatesActionHandler(Handler):
+    field = "duplicates action"
+    ACTIONS = ("report", "link", "move")
+
+    def validate(self, action):
+        if not action:
+            raise ValueError("What to do with duplicates: report, link or move?")
+        if action.lower() not in self.ACTIONS:
+            raise ValueError("Choose report, link or move")
+        
+        return action.lower()
     
 class IdHandler(Handler):
-    def handle(self, args) -> str:
-        if "id" not in args:
-            return super().handle(args)
-        id = args["id"]
+    field = "id"
+
+    def validate(self, id) -> str:
         if not id:
             raise ValueError("Give me id:")
         
         return id
     
 class SearchHandler(Handler):
-    def handle(self, args) -> str:
-        if "search" not in args:
-            return super().handle(args)
-        search = args["search"]
+    field = "search"
+
+    def validate(self, search) -> str:
         if not search:
             raise ValueError("What do you want to search:")
         
         return search
     
 class IntersecHandler(Handler):
-    def handle(self, args):
-        if "intersec" not in args:
-            return super().handle(args)
-        intersec = args["intersec"]
+    field = "intersec"
+
+    def validate(self, intersec):
         if intersec is None:
             raise ValueError("All of your tags in each record?(Y/N)")
         
         return intersec.lower() == "y"
     
 class FieldHandler(Handler):
-    def handle(self, args):
-        if "field" not in args:
-            return super().handle(args)
-        field = args["field"]
+    field = "field"
+
+    def validate(self, field):
         if not field:
             raise ValueError("What field do you want to edit:")
         
         return field
     
 class TagHandler(Handler):
-    def handle(self, args):
-        if "tag" not in args:
-            return super().handle(args)
-        tag = args["tag"]
+    field = "tag"
+
+    def validate(self, tag):
         if not tag:
             raise ValueError("Enter tag:")
         
-        return tag
\ No newline at end of file
+        return tag
+
+class DaysHandler(Handler):
+    field = "days"
+
+    def validate(self, days):
+        if not days:
+            raise ValueError("How many days ahead?")
+        if not days.isdigit():
+            raise ValueError("Days must be a positive number")
+        
+        return int(days)
+
+class ImportFileHandler(Handler):
+    field = "import file"
+
+    def validate(self, path):
+        if not path:
+            raise ValueError("Give me a file to import")
+        if not Path(path).is_file():
+            raise ValueError("There is no such file")
+        
+        return path
+
+class ExportFileHandler(Handler):
+    field = "export file"
+
+    def validate(self, path):
+        if not path:
+            raise ValueError("Give me a file to export to")
+        if not Path(path).parent.is_dir():
+            raise ValueError("invalid path")
+        
+        return path
+
+class StatsFileHandler(Handler):
+    field = "stats file"
+
+    def validate(self, path):
+        if not path:
+            raise ValueError("Give me a file for statistics (.json or .prom)")
+        if not Path(path).parent.is_dir():
+            raise ValueError("invalid path")
+        
+        return path
+
+
+HANDLERS = (NameHandler, PhoneHandler, BirthdayHandler, EmailHandler, TextHadnler,
+            TagsHandler, FolderHandler, IdHandler, SearchHandler, IntersecHandler,
+            FieldHandler, TagHandler, DaysHandler, ImportFileHandler, ExportFileHandler,
+            StatsFileHandler, DryRunHandler, DuplicatesActionHandler)
+
+
+class Validator:
+    """
+    Registry of argument handlers looked up by field name
+    """
+    def __init__(self, handlers=HANDLERS):
+        self.validators = {}
+        for handler in handlers:
+            self.register(handler())
+
+    def register(self, handler: Handler) -> None:
+        self.validators[handler.field] = handler.validate
+
+    @timed("Validator.validate")
+    def validate(self, field: str, value):
+        try:
+            validate = self.validators[field]
+        except KeyError:
+            raise ValueError(f"Unknown argument {field}")
+        return validate(value)
+
+    def validate_record(self, args: dict, optional=()) -> (dict, dict):
+        """
+        Validates every argument, list values item by item.
+        Returns validated values and error messages by field,
+        empty optional arguments are left out
+        """
+        values = {}
+        errors = {}
+        for field, value in args.items():
+            if field in optional and not value:
+                continue
+            try:
+                if isinstance(value, list):
+                    values[field] = [self.validate(field, item) for item in value]
+                else:
+                    values[field] = self.validate(field, value)
+            except ValueError as error:
+                errors[field] = str(error)
+        return values, errors
+
+    def validate_many(self, records: [dict], optional=()) -> [(dict, dict)]:
+        """
+        Validates a list of records in one pass, collecting every error.
+        Returns validated values and error messages by field of each record
+        """
+        return [self.validate_record(args, optional) for args in records]
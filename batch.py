@@ -0,0 +1,84 @@
+import json
+from contextlib import ExitStack
+from shlex import split
+from handler import CommandCreator, Command
+
+
+class BatchRunner:
+    """
+    Runs whole commands with their arguments, one per line,
+    and reports every result as a JSON line
+    """
+    TARGETS = ("contacts", "notes")
+    EXIT_COMMANDS = ("exit", "close", "good bye")
+
+    def __init__(self, output, flush_every: int = 0):
+        self.output = output
+        self.flush_every = flush_every  # 0 - flush once at the end
+        self.handler = CommandCreator()
+        self.stopped = False
+        self.stack = None
+
+    def parse(self, line: str) -> (str, [str]):
+        words = split(line)
+        # two-word commands like "add phone" win over "add"
+        for size in (2, 1):
+            name = " ".join(words[:size]).lower()
+            if name in self.handler.commands or name in self.TARGETS:
+                return name, words[size:]
+        return words[0].lower(), words[1:]
+
+    def run_line(self, line: str) -> dict:
+        name, args = self.parse(line)
+        if name in self.TARGETS:
+            self.handler.set_target(name)
+            if self.stack is not None and self.handler.target not in self.batched:
+                # targets are opened on first use, join the running batch
+                self.batched.append(self.handler.target)
+                self.stack.enter_context(self.handler.target.batch())
+            return {"command": name, "ok": True, "result": ""}
+
+        cmd: Command = self.handler.create(name)
+        for arg in args:
+            cmd.set_args(arg)
+        result = cmd.execute()
+        if name in self.EXIT_COMMANDS:
+            self.stopped = True
+        return {"command": name, "ok": cmd.success, "result": result}
+
+    def batch(self, stack: ExitStack) -> None:
+        self.stack = stack
+        self.batched = self.handler.targets.loaded()
+        for target in self.batched:
+            stack.enter_context(target.batch())
+
+    def run(self, lines) -> int:
+        """Runs script lines, returns number of failed commands"""
+        failed = 0
+        done = 0
+        stack = ExitStack()
+        self.batch(stack)
+        try:
+            for line_no, line in enumerate(lines, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    report = self.run_line(line)
+                except Exception as error:
+                    report = {"command": line, "ok": False, "result": str(error)}
+                report["line"] = line_no
+                failed += not report["ok"]
+                self.output.write(json.dumps(report, ensure_ascii=False) + "\n")
+
+                done += 1
+                if self.flush_every and done % self.flush_every == 0:
+                    stack.close()
+                    stack = ExitStack()
+                    self.batch(stack)
+                if self.stopped:
+                    break
+        finally:
+            self.stack = None
+            stack.close()
+        return failed
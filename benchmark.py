@@ -0,0 +1,278 @@
+#########################
+#-------Benchmarks------#
+#########################
+import json
+import os
+import platform
+import random
+import sys
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import date, datetime, timedelta
+from itertools import islice
+from tempfile import TemporaryDirectory
+from time import perf_counter_ns
+from address_book import AddressBook, Record, Name, Phone, Birthday, Email
+from notebook import NoteBook, Note
+from handler import CommandCreator, Targets
+
+try:
+    from resource import getrusage, RUSAGE_SELF
+except ImportError:
+    getrusage = None
+
+FIRST_NAMES = ["John", "Mary", "Olena", "Petro", "Ivan", "Anna", "Sergiy", "Oksana",
+               "Taras", "Kateryna", "Dmytro", "Iryna", "Mykola", "Olga", "José", "Zoë"]
+LAST_NAMES = ["Smith", "Shevchenko", "Kovalenko", "Bondarenko", "Tkachenko", "Kravchenko",
+              "Melnyk", "Boyko", "Moroz", "Lysenko", "Müller", "García", "Novak", "Rudenko"]
+WORDS = ["meeting", "project", "call", "budget", "report", "idea", "travel", "review",
+         "shopping", "family", "health", "book", "code", "release", "plan", "draft"]
+TAGS = ["work", "home", "urgent", "ideas", "python", "travel", "family", "later",
+        "finance", "health", "reading", "music"]
+
+QUERIES = 1000  # lookups timed per case
+DURABLE_ADDS = 200  # adds timed with a flush each
+PAGES = 1000  # pages listed at most
+
+
+class Benchmark:
+    """
+    Times operations one by one and keeps a result per case:
+    throughput, latency percentiles and, if asked, peak traced memory
+    """
+    def __init__(self, memory: bool = False, output=sys.stdout):
+        self.memory = memory
+        self.output = output
+        self.results = []
+
+    def measure(self, case: str, size: int, operation, count: int) -> dict:
+        """Calls operation(i) count times"""
+        latencies = []
+        if self.memory:
+            tracemalloc.start()
+        for i in range(count):
+            start = perf_counter_ns()
+            operation(i)
+            latencies.append(perf_counter_ns() - start)
+        peak = None
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return self.record(case, size, latencies, peak)
+
+    def record(self, case: str, size: int, latencies: [int], peak: int = None) -> dict:
+        latencies.sort()
+        total = sum(latencies)
+        result = {
+                "case": case,
+                "size": size,
+                "count": len(latencies),
+                "seconds": round(total / 1e9, 6),
+                "ops_per_sec": round(len(latencies) / (total / 1e9), 1) if total else None,
+                "p50_us": percentile(latencies, 0.5),
+                "p95_us": percentile(latencies, 0.95),
+                "p99_us": percentile(latencies, 0.99),
+                "max_us": round(latencies[-1] / 1000, 1) if latencies else None,
+                }
+        if peak is not None:
+            result["peak_kb"] = peak // 1024
+        self.results.append(result)
+        self.output.write(format_result(result) + "\n")
+        self.output.flush()
+        return result
+
+
+def percentile(latencies: [int], share: float) -> float:
+    if not latencies:
+        return None
+    return round(latencies[min(len(latencies) - 1, int(len(latencies) * share))] / 1000, 1)
+
+
+def format_result(result: dict) -> str:
+    line = f"{result['case']:<24}{result['size']:>9}  {result['ops_per_sec'] or 0:>12.1f} op/s  " \
+           f"p50 {result['p50_us']:>9} us  p95 {result['p95_us']:>9} us  p99 {result['p99_us']:>9} us"
+    if "peak_kb" in result:
+        line += f"  peak {result['peak_kb']} KB"
+    return line
+
+
+#----Synthetic data----#
+
+def make_contact(i: int, rnd: random.Random) -> Record:
+    name = f"{rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAMES)} {i}"
+    record = Record(Name(name, True))
+    record.add_phone(Phone(f"{1000000000 + i}"))
+    if rnd.random() < 0.2:
+        record.add_phone(Phone(f"{2000000000 + i}"))
+    if rnd.random() < 0.7:
+        birthday = date(1950, 1, 1) + timedelta(days=rnd.randrange(365 * 55))
+        record.add_birthday(Birthday(birthday.strftime(Birthday.DATE_FORMAT)))
+    if rnd.random() < 0.5:
+        record.add_email(Email(f"user{i}@example.com"))
+    return record
+
+
+def make_note(rnd: random.Random) -> Note:
+    text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(5, 30)))
+    return Note(text, rnd.sample(TAGS, rnd.randint(1, 3)))
+
+
+def contact_queries(book, rnd: random.Random, count: int) -> [str]:
+    # parts of existing names and phones plus some misses
+    names = list(islice(book.keys(), 100000))
+    queries = []
+    for i in range(count):
+        if i % 10 == 9:
+            queries.append(f"missing{i}")
+        elif i % 3 == 0:
+            queries.append(str(1000000000 + rnd.randrange(len(book)))[-6:])
+        else:
+            name = rnd.choice(names)
+            start = rnd.randrange(max(1, len(name) - 5))
+            queries.append(name[start: start + 5])
+    return queries
+
+
+#----Cases----#
+
+def bench_contacts(bench: Benchmark, size: int, folder: str) -> None:
+    rnd = random.Random(size)
+    file_name = os.path.join(folder, f"contacts_{size}.bin")
+    book = AddressBook(file_name)
+    records = [make_contact(i, rnd) for i in range(size)]
+
+    with book.batch():
+        bench.measure("contacts.add", size, lambda i, records=records: book.add(records[i]), size)
+    del records
+    extra = [make_contact(size + i, rnd) for i in range(DURABLE_ADDS)]
+    bench.measure("contacts.add_durable", size, lambda i: book.add(extra[i]), DURABLE_ADDS)
+
+    queries = contact_queries(book, rnd, QUERIES)
+    bench.measure("contacts.find", size, lambda i: book.find(queries[i]), QUERIES)
+
+    keys = list(islice(book.keys(), QUERIES))
+
+    def change(i):
+        record = book[keys[i]]
+        record.add_email(Email(f"changed{i}@example.com"))
+        book.save()
+    bench.measure("contacts.save", size, change, len(keys))
+    bench.measure("contacts.compact", size, lambda i: book.compact(), 1)
+    bench.measure("contacts.restore", size, lambda i: AddressBook(file_name), 1)
+
+    pagination = book.iterator(10)
+    bench.measure("pagination.next", size, lambda i: next(pagination), min(PAGES, pagination.pages_count))
+
+    bench_commands(bench, size, book, queries)
+    book.journal.close()
+
+
+def bench_commands(bench: Benchmark, size: int, book: AddressBook, queries: [str]) -> None:
+    creator = CommandCreator()
+    creator.targets = Targets(lambda name: book)
+    creator.set_target("contacts")
+
+    def find(i):
+        command = creator.create("find")
+        command.set_args(queries[i])
+        command.execute()
+    bench.measure("command.find", size, find, len(queries))
+
+    def show(i):
+        creator.create("show").execute()
+    bench.measure("command.show", size, show, QUERIES)
+
+
+def bench_notes(bench: Benchmark, size: int, folder: str) -> None:
+    rnd = random.Random(size + 1)
+    file_name = os.path.join(folder, f"notes_{size}.bin")
+    book = NoteBook(file_name)
+    notes = [make_note(rnd) for i in range(size)]
+
+    with book.batch():
+        bench.measure("notes.add", size, lambda i, notes=notes: book.add(notes[i]), size)
+    del notes
+    tag_queries = [rnd.sample(TAGS, rnd.randint(1, 2)) for i in range(QUERIES)]
+    bench.measure("notes.find", size, lambda i: book.find(tag_queries[i], i % 2 == 0), QUERIES)
+    words = [rnd.choice(WORDS) + " " + rnd.choice(WORDS) for i in range(QUERIES)]
+    bench.measure("notes.search", size, lambda i: book.search(words[i], 10), QUERIES)
+    bench.measure("notes.gen_id", size, lambda i: book.gen_id(), QUERIES)
+    book.journal.close()
+
+
+def bench_memory(bench: Benchmark, size: int) -> None:
+    """Traced memory of an in-memory book without files"""
+    rnd = random.Random(size)
+    tracemalloc.start()
+    start = perf_counter_ns()
+    book = AddressBook()
+    for i in range(size):
+        book.add(make_contact(i, rnd))
+    elapsed = perf_counter_ns() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del book
+    bench.record("contacts.memory", size, [elapsed], peak)
+
+
+def run(sizes: [int], memory: bool = False, output=sys.stdout) -> dict:
+    bench = Benchmark(memory, output)
+    with TemporaryDirectory() as folder:
+        for size in sizes:
+            bench_contacts(bench, size, folder)
+            bench_notes(bench, size, folder)
+            bench_memory(bench, size)
+    meta = {
+            "started": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sizes": sizes,
+            }
+    if getrusage is not None:
+        # kilobytes on Linux
+        meta["max_rss_kb"] = getrusage(RUSAGE_SELF).ru_maxrss
+    return {"meta": meta, "results": bench.results}
+
+
+#----Comparing runs----#
+
+def compare(baseline: dict, current: dict, threshold: float) -> [str]:
+    """Cases whose throughput fell or memory grew by more than threshold"""
+    old = {(result["case"], result["size"]): result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        before = old.get((result["case"], result["size"]))
+        if before is None:
+            continue
+        name = f"{result['case']} @ {result['size']}"
+        if before["ops_per_sec"] and result["ops_per_sec"] \
+                and result["ops_per_sec"] < before["ops_per_sec"] * (1 - threshold):
+            regressions.append(f"{name}: {before['ops_per_sec']} -> {result['ops_per_sec']} op/s")
+        if before.get("peak_kb") and result.get("peak_kb") \
+                and result["peak_kb"] > before["peak_kb"] * (1 + threshold):
+            regressions.append(f"{name}: {before['peak_kb']} -> {result['peak_kb']} KB")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmarks of address book, notebook and commands")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000],
+                        help="numbers of contacts and notes to generate (1000000 takes a while)")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file for the results")
+    parser.add_argument("--compare", metavar="BASELINE", help="results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed slowdown before a case counts as regression (0.2 = 20%%)")
+    parser.add_argument("--memory", action="store_true",
+                        help="trace peak memory of every case, timings get slower")
+    options = parser.parse_args()
+
+    results = run(options.sizes, options.memory)
+    with open(options.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+
+    if options.compare:
+        with open(options.compare, "r", encoding="utf-8") as f:
+            regressions = compare(json.load(f), results, options.threshold)
+        for regression in regressions:
+            print("Regression:", regression)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,286 @@
+#########################
+#---Bulk import/export--#
+#########################
+import csv
+import json
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+from address_book import Record, Birthday
+from notebook import Note
+from arg_handlers import Validator
+
+BATCH_SIZE = 1000  # rows validated and committed together
+MAX_ERRORS = 1000  # rejected rows kept with their messages
+VALIDATOR = Validator()
+
+
+class ImportReport:
+    SHOW_ERRORS = 10
+
+    def __init__(self):
+        self.imported = 0
+        self.rejected = 0
+        self.errors = []  # (line number, message)
+
+    def reject(self, line: int, message: str) -> None:
+        self.rejected += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((line, message))
+
+    def __str__(self) -> str:
+        lines = [f"Imported: {self.imported}, rejected: {self.rejected}"]
+        for line, message in self.errors[:self.SHOW_ERRORS]:
+            lines.append(f"line {line}: {message}")
+        if self.rejected > self.SHOW_ERRORS:
+            lines.append(f"... and {self.rejected - self.SHOW_ERRORS} more")
+        return "\n".join(lines)
+
+
+#----Readers: yield (line number, item)----#
+
+def read_jsonl(f):
+    for line_no, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except ValueError as error:
+            yield line_no, error
+
+
+def read_contacts_csv(f):
+    reader = csv.DictReader(f)
+    for row in reader:
+        row["phones"] = [p for p in (row.get("phones") or "").split(";") if p]
+        yield reader.line_num, row
+
+
+def read_notes_csv(f):
+    reader = csv.DictReader(f)
+    for row in reader:
+        row["tags"] = (row.get("tags") or "").split()
+        yield reader.line_num, row
+
+
+def vcard_escape(value: str) -> str:
+    """Text value escaped as RFC 6350 asks"""
+    value = value.replace("\\", "\\\\").replace(",", "\\,").replace(";", "\\;")
+    return value.replace("\r\n", "\\n").replace("\n", "\\n").replace("\r", "\\n")
+
+
+def vcard_unescape(value: str) -> str:
+    chars = []
+    escaped = False
+    for char in value:
+        if escaped:
+            chars.append("\n" if char in "nN" else char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        else:
+            chars.append(char)
+    return "".join(chars)
+
+
+def unfold(f):
+    """(line number, content line) with folded continuation lines joined"""
+    start, line = 0, None
+    for line_no, physical in enumerate(f, 1):
+        physical = physical.rstrip("\r\n")
+        if physical[:1] in (" ", "\t") and line is not None:
+            line += physical[1:]
+            continue
+        if line:
+            yield start, line
+        start, line = line_no, physical
+    if line:
+        yield start, line
+
+
+def read_vcard(f):
+    item = None
+    start = 0
+    for line_no, line in unfold(f):
+        key, _, value = line.partition(":")
+        key = key.split(";")[0].upper()
+        if key == "BEGIN":
+            item = {"phones": []}
+            start = line_no
+        elif key == "END" and item is not None:
+            yield start, item
+            item = None
+        elif item is None:
+            continue
+        elif key == "FN":
+            item["name"] = vcard_unescape(value)
+        elif key == "TEL":
+            # keep the last 10 digits, dropping country code and punctuation
+            item["phones"].append("".join(c for c in value if c.isdigit())[-10:])
+        elif key == "EMAIL":
+            item["email"] = vcard_unescape(value)
+        elif key == "BDAY":
+            digits = value.replace("-", "")
+            try:
+                item["birthday"] = datetime.strptime(digits, "%Y%m%d").strftime(Birthday.DATE_FORMAT)
+            except ValueError:
+                item["birthday"] = value
+
+
+#----Builders: item -> validated record----#
+
+def make_record(item: dict) -> Record:
+    phones = item.get("phones") or []
+    if isinstance(phones, str):
+        phones = [phones]
+    values, errors = VALIDATOR.validate_record({
+            "name": item.get("name"),
+            "phone": phones,
+            "birthday": item.get("birthday"),
+            "email": item.get("email"),
+            }, optional=("phone", "birthday", "email"))
+    if errors:
+        raise ValueError("; ".join(f"{field}: {message}" for field, message in errors.items()))
+    record = Record(values["name"])
+    for phone in values.get("phone", []):
+        record.add_phone(phone)
+    record.add_birthday(values.get("birthday"))
+    record.add_email(values.get("email"))
+    return record
+
+
+def make_note(item: dict) -> Note:
+    if not item.get("text"):
+        raise ValueError("Note text is empty")
+    tags = item.get("tags") or []
+    if isinstance(tags, str):
+        tags = tags.split()
+    note = Note(item["text"], tags)
+    if item.get("created"):
+        note.created = datetime.fromisoformat(item["created"])
+    return note
+
+
+#----Writers: stream records to file----#
+
+def write_contacts_csv(f, records) -> int:
+    writer = csv.writer(f)
+    writer.writerow(["name", "phones", "birthday", "email"])
+    count = 0
+    for record in records:
+        writer.writerow([record.name.value,
+                         ";".join(p.value for p in record.phones),
+                         str(record.birthday) if record.birthday else "",
+                         record.email.value if record.email else ""])
+        count += 1
+    return count
+
+
+def write_contacts_jsonl(f, records) -> int:
+    count = 0
+    for record in records:
+        item = {
+                "name": record.name.value,
+                "phones": [p.value for p in record.phones],
+                "birthday": str(record.birthday) if record.birthday else None,
+                "email": record.email.value if record.email else None,
+                }
+        f.write(json.dumps(item, ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+
+def write_vcard(f, records) -> int:
+    count = 0
+    for record in records:
+        lines = ["BEGIN:VCARD", "VERSION:3.0", f"FN:{vcard_escape(record.name.value)}"]
+        lines.extend(f"TEL:{p.value}" for p in record.phones)
+        if record.birthday:
+            lines.append(f"BDAY:{record.birthday.value.isoformat()}")
+        if record.email:
+            lines.append(f"EMAIL:{vcard_escape(record.email.value)}")
+        lines.append("END:VCARD")
+        f.write("\n".join(lines) + "\n")
+        count += 1
+    return count
+
+
+def write_notes_csv(f, notes) -> int:
+    writer = csv.writer(f)
+    writer.writerow(["id", "created", "text", "tags"])
+    count = 0
+    for note in notes:
+        writer.writerow([note.id, note.created.isoformat(), note.text, " ".join(sorted(note.tags))])
+        count += 1
+    return count
+
+
+def write_notes_jsonl(f, notes) -> int:
+    count = 0
+    for note in notes:
+        f.write(json.dumps(note.to_dict(), ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+
+FORMATS = {
+    Record: {
+        ".csv": (read_contacts_csv, write_contacts_csv),
+        ".jsonl": (read_jsonl, write_contacts_jsonl),
+        ".vcf": (read_vcard, write_vcard),
+        ".vcard": (read_vcard, write_vcard),
+    },
+    Note: {
+        ".csv": (read_notes_csv, write_notes_csv),
+        ".jsonl": (read_jsonl, write_notes_jsonl),
+    },
+}
+BUILDERS = {Record: make_record, Note: make_note}
+
+
+def get_format(record_class, file_name: str):
+    suffix = Path(file_name).suffix.lower()
+    formats = FORMATS[record_class]
+    if suffix not in formats:
+        raise ValueError(f"Supported formats: {', '.join(formats)}")
+    return formats[suffix]
+
+
+def import_records(target, record_class, file_name: str) -> ImportReport:
+    """Adds records from file batch by batch, one commit per batch"""
+    read, write = get_format(record_class, file_name)
+    build = BUILDERS[record_class]
+    report = ImportReport()
+    with open(file_name, "r", encoding="utf-8", newline="") as f:
+        rows = read(f)
+        while True:
+            chunk = list(islice(rows, BATCH_SIZE))
+            if not chunk:
+                break
+            records = []
+            for line, item in chunk:
+                try:
+                    if isinstance(item, Exception):
+                        raise item
+                    if not isinstance(item, dict):
+                        raise ValueError("Row must be an object")
+                    records.append((line, build(item)))
+                except (ValueError, TypeError, AttributeError) as error:
+                    report.reject(line, str(error))
+
+            with target.batch():
+                for line, record in records:
+                    try:
+                        target.add(record)
+                        report.imported += 1
+                    except ValueError as error:
+                        report.reject(line, str(error))
+    return report
+
+
+def export_records(target, record_class, file_name: str) -> int:
+    """Writes all records to file one by one, returns their number"""
+    read, write = get_format(record_class, file_name)
+    records = (record for key, record in target.records_after())
+    with open(file_name, "w", encoding="utf-8", newline="") as f:
+        return write(f, records)
@@ -0,0 +1,538 @@
+#########################
+#------File sorter------#
+#########################
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Lock
+from journal import Journal
+from metrics import METRICS, timed
+
+CATEGORIES = {
+    "images": (".jpeg", ".jpg", ".png", ".gif", ".svg", ".bmp", ".webp", ".tiff", ".heic"),
+    "video": (".avi", ".mp4", ".mov", ".mkv", ".webm", ".wmv"),
+    "documents": (".doc", ".docx", ".txt", ".pdf", ".xls", ".xlsx", ".ppt", ".pptx",
+                  ".odt", ".ods", ".rtf", ".csv", ".md"),
+    "audio": (".mp3", ".ogg", ".wav", ".amr", ".flac", ".m4a", ".aac"),
+    "archives": (".zip", ".gz", ".tar", ".7z", ".rar", ".bz2", ".xz"),
+}
+OTHER = "other"
+DUPLICATES = "duplicates"
+SORTED = frozenset((*CATEGORIES, OTHER, DUPLICATES))  # folders of the root left as they are
+EXTENSIONS = {extension: category for category, extensions in CATEGORIES.items()
+              for extension in extensions}
+
+SNIFF_SIZE = 16
+# leading bytes of common formats: (signature, category, extension)
+SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "images", ".png"),
+    (b"\xff\xd8\xff", "images", ".jpg"),
+    (b"GIF87a", "images", ".gif"),
+    (b"GIF89a", "images", ".gif"),
+    (b"BM", "images", ".bmp"),
+    (b"%PDF-", "documents", ".pdf"),
+    (b"{\\rtf", "documents", ".rtf"),
+    (b"PK\x03\x04", "archives", ".zip"),
+    (b"\x1f\x8b", "archives", ".gz"),
+    (b"7z\xbc\xaf\x27\x1c", "archives", ".7z"),
+    (b"Rar!\x1a\x07", "archives", ".rar"),
+    (b"BZh", "archives", ".bz2"),
+    (b"\xfd7zXZ\x00", "archives", ".xz"),
+    (b"ID3", "audio", ".mp3"),
+    (b"OggS", "audio", ".ogg"),
+    (b"fLaC", "audio", ".flac"),
+    (b"#!AMR", "audio", ".amr"),
+    (b"\x1aE\xdf\xa3", "video", ".mkv"),
+)
+RIFF_TYPES = {b"WAVE": ("audio", ".wav"), b"AVI ": ("video", ".avi"), b"WEBP": ("images", ".webp")}
+# ISO media files keep their brand after "ftyp"
+MP4_BRANDS = {b"M4A ": ("audio", ".m4a"), b"heic": ("images", ".heic"), b"qt  ": ("video", ".mov")}
+
+
+def sniff(path: str) -> (str, str):
+    """Category and extension by the first bytes of the file, None if unknown"""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(SNIFF_SIZE)
+    except OSError:
+        return None
+    for signature, category, extension in SIGNATURES:
+        if head.startswith(signature):
+            return category, extension
+    if head[:4] == b"RIFF":
+        return RIFF_TYPES.get(head[8:12])
+    if head[4:8] == b"ftyp":
+        return MP4_BRANDS.get(head[8:12], ("video", ".mp4"))
+    return None
+
+
+def classify(name: str, path: str) -> (str, str):
+    """
+    Category of the file and its new name. Unknown extensions are
+    checked by content, files without extension get the one found.
+    """
+    stem, extension = os.path.splitext(name)
+    category = EXTENSIONS.get(extension.lower())
+    if category is not None:
+        return category, name
+    sniffed = sniff(path)
+    if sniffed is None:
+        return OTHER, name
+    category, found = sniffed
+    if not extension:
+        name += found
+    return category, name
+
+
+def scan(root: str, skip=SORTED):
+    """
+    Yields regular files under root one by one. Category folders
+    in root are already sorted and skipped, so does a stopped run.
+    """
+    folders = [root]
+    while folders:
+        folder = folders.pop()
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if folder != root or entry.name not in skip:
+                            folders.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry
+        except OSError:
+            # unreadable folder, the rest is sorted anyway
+            continue
+
+
+class SortReport:
+    SHOW_ERRORS = 10
+    SHOW_PLAN = 20
+
+    def __init__(self, dry_run: bool = False):
+        self.dry_run = dry_run
+        self.scanned = 0
+        self.moved = 0
+        self.renamed = 0
+        self.failed = 0
+        self.categories = {}  # category: number of files
+        self.plan = []  # first planned moves (source, destination)
+        self.errors = []  # (file, message)
+
+    def done(self, source: str, destination: str, category: str, renamed: bool) -> None:
+        self.moved += 1
+        self.renamed += renamed
+        self.categories[category] = self.categories.get(category, 0) + 1
+        if self.dry_run and len(self.plan) < self.SHOW_PLAN:
+            self.plan.append((source, destination))
+
+    def fail(self, source: str, message: str) -> None:
+        self.failed += 1
+        if len(self.errors) < self.SHOW_ERRORS:
+            self.errors.append((source, message))
+
+    def progress(self) -> str:
+        return f"scanned {self.scanned}, moved {self.moved}, failed {self.failed}"
+
+    def __str__(self) -> str:
+        action = "Would move" if self.dry_run else "Moved"
+        lines = [f"{action} {self.moved} of {self.scanned} files, renamed: {self.renamed}, failed: {self.failed}"]
+        for category in sorted(self.categories):
+            lines.append(f"{category}: {self.categories[category]}")
+        for source, destination in self.plan:
+            lines.append(f"{source} -> {destination}")
+        if self.dry_run and self.moved > len(self.plan):
+            lines.append(f"... and {self.moved - len(self.plan)} more")
+        for source, message in self.errors:
+            lines.append(f"{source}: {message}")
+        if self.failed > len(self.errors):
+            lines.append(f"... and {self.failed - len(self.errors)} more errors")
+        return "\n".join(lines)
+
+
+class FileSorter:
+    """
+    Moves files of a folder tree into category folders in its root.
+    Files are listed lazily and moved by a few threads with a bounded
+    queue, so memory does not grow with the number of files.
+    A stopped run is resumed by running again: sorted files
+    are not listed any more.
+    """
+    PROGRESS_EVERY = 1000
+    MAX_NUMBERS = 100000  # names whose last free number is remembered
+
+    def __init__(self, root, workers: int = 4, progress=None):
+        self.root = os.path.abspath(root)
+        self.workers = workers
+        self.progress = progress  # called with the report every PROGRESS_EVERY files
+        self.report = None
+        self._lock = Lock()
+        self._reserved = set()  # destinations of moves in flight
+        self._folders = set()  # category folders already created
+        self._numbers = {}  # taken path: last number given to its copies
+
+    def destination(self, category: str, name: str) -> str:
+        """Free path in the category folder, "name (1).ext" if the name is taken"""
+        folder = os.path.join(self.root, category)
+        stem, extension = os.path.splitext(name)
+        taken = path = os.path.join(folder, name)
+        # many folders hold files with the same names, don't check every number again
+        number = self._numbers.get(taken, 0)
+        if number:
+            path = os.path.join(folder, f"{stem} ({number}){extension}")
+        while path in self._reserved or os.path.lexists(path):
+            number += 1
+            path = os.path.join(folder, f"{stem} ({number}){extension}")
+        if number:
+            if len(self._numbers) >= self.MAX_NUMBERS:
+                self._numbers.clear()
+            self._numbers[taken] = number
+        return path
+
+    def move(self, entry: os.DirEntry) -> None:
+        try:
+            category, name = classify(entry.name, entry.path)
+            with self._lock:
+                destination = self.destination(category, name)
+                if not self.report.dry_run:
+                    self._reserved.add(destination)
+            if not self.report.dry_run:
+                try:
+                    if category not in self._folders:
+                        os.makedirs(os.path.dirname(destination), exist_ok=True)
+                        self._folders.add(category)
+                    os.rename(entry.path, destination)
+                finally:
+                    with self._lock:
+                        self._reserved.discard(destination)
+        except OSError as error:
+            with self._lock:
+                self.report.fail(entry.path, error.strerror or str(error))
+            return
+        with self._lock:
+            self.report.done(entry.path, destination, category,
+                             os.path.basename(destination) != entry.name)
+
+    @timed()
+    def run(self, dry_run: bool = False) -> SortReport:
+        self.report = SortReport(dry_run)
+        if dry_run:
+            # nothing is moved, so the plan is made in one thread
+            for entry in scan(self.root):
+                self.report.scanned += 1
+                self.move(entry)
+                self.notify()
+            return self.report
+
+        slots = BoundedSemaphore(self.workers * 4)
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="sorter") as pool:
+            for entry in scan(self.root):
+                slots.acquire()
+                self.report.scanned += 1
+                pool.submit(self.move, entry).add_done_callback(lambda future: slots.release())
+                self.notify()
+        self.remove_empty(self.root)
+        METRICS.count("sorter.files_moved", self.report.moved)
+        return self.report
+
+    def notify(self) -> None:
+        if self.progress is not None and self.report.scanned % self.PROGRESS_EVERY == 0:
+            self.progress(self.report)
+
+    def remove_empty(self, folder: str) -> bool:
+        """Deletes folders left empty, category folders stay. True if folder is empty"""
+        empty = True
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if not entry.is_dir(follow_symlinks=False):
+                        empty = False
+                    elif folder == self.root and entry.name in SORTED:
+                        empty = False
+                    elif self.remove_empty(entry.path):
+                        try:
+                            os.rmdir(entry.path)
+                        except OSError:
+                            empty = False
+                    else:
+                        empty = False
+        except OSError:
+            return False
+        return empty
+
+
+#----Duplicates----#
+
+PARTIAL_SIZE = 64 * 1024  # first bytes hashed to tell apart files of the same size
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_hash(path: str, limit: int = None) -> bytes:
+    """Hash of the file or of its first limit bytes, None if it can't be read"""
+    digest = hashlib.blake2b(digest_size=20)
+    try:
+        with open(path, "rb") as f:
+            if limit is not None:
+                digest.update(f.read(limit))
+            else:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+    except OSError:
+        return None
+    return digest.digest()
+
+
+def stat_key(stat: os.stat_result) -> tuple:
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class HashCache:
+    """
+    Partial and full hashes of files kept between runs. A file is known
+    by (device, inode, size, mtime), so changed files are hashed again.
+    Files under the scanned folders the scan didn't find are dropped on
+    compaction, files elsewhere only if they are gone or changed.
+    """
+    def __init__(self, file_name: str = None):
+        self.journal = Journal(file_name) if file_name else None
+        self.data = self.journal.load() if self.journal else {}  # key: (partial, full, path)
+        self.seen = set()  # keys of files found by this run
+        self.roots = set()  # folders scanned by this run
+
+    def touch(self, keys, root: str = None) -> None:
+        self.seen.update(keys)
+        if root is not None:
+            self.roots.add(os.path.join(root, ""))
+
+    def get(self, key: tuple, full: bool) -> bytes:
+        hashes = self.data.get(key)
+        return hashes[full] if hashes else None
+
+    def path(self, key: tuple) -> str:
+        # caches written before paths were kept have none
+        hashes = self.data[key]
+        return hashes[2] if len(hashes) > 2 else None
+
+    def set(self, key: tuple, full: bool, value: bytes, path: str = None) -> None:
+        partial, whole = self.data.get(key, (None, None))[:2]
+        hashes = (partial, value, path) if full else (value, whole, path)
+        self.data[key] = hashes
+        if self.journal is not None:
+            self.journal.append(key, hashes)
+
+    @contextmanager
+    def batch(self):
+        """Hashes found inside are written at once, under the lock of the cache file"""
+        if self.journal is None:
+            yield self
+            return
+        with self.journal.batch():
+            changes = self.journal.lock()
+            if changes is None:
+                # compacted by another process
+                self.data = self.journal.load()
+            else:
+                self.data.update(changes)
+                # files of other runs are kept too
+                self.touch(changes)
+            yield self
+
+    def close(self) -> None:
+        if self.journal is None:
+            return
+        unseen = [key for key in self.data if key not in self.seen] if self.seen else []
+        # the scan finds every file of its folders, the ones it didn't are deleted or changed
+        roots = tuple(self.roots)
+        stale = {key for key in unseen if (self.path(key) or "").startswith(roots)} if roots else set()
+        if self.journal.should_compact() or len(stale) > len(self.data) // 2:
+            with self.batch():
+                for key in unseen:
+                    if key not in self.seen and key in self.data \
+                            and (key in stale or self.missing(key)):
+                        self.data.pop(key)
+                self.journal.snapshot(self.data)
+        self.journal.close()
+
+    def missing(self, key: tuple) -> bool:
+        """True if the file hashed for key is gone or changed"""
+        path = self.path(key)
+        if path is None:
+            return True
+        try:
+            return stat_key(os.stat(path, follow_symlinks=False)) != key
+        except OSError:
+            return True
+
+
+class DuplicateReport:
+    SHOW_GROUPS = 10
+    SHOW_ERRORS = 10
+
+    def __init__(self, action: str = "report"):
+        self.action = action
+        self.scanned = 0
+        self.hashed = 0
+        self.groups = 0
+        self.duplicates = 0
+        self.wasted = 0  # bytes taken by duplicates
+        self.done = 0
+        self.failed = 0
+        self.shown = []  # first groups of equal files
+        self.errors = []  # (file, message)
+
+    def found(self, files: [(str, tuple)]) -> None:
+        size = files[0][1][2]
+        self.groups += 1
+        self.duplicates += len(files) - 1
+        self.wasted += size * (len(files) - 1)
+        if len(self.shown) < self.SHOW_GROUPS:
+            self.shown.append([path for path, key in files])
+
+    def fail(self, source: str, message: str) -> None:
+        self.failed += 1
+        if len(self.errors) < self.SHOW_ERRORS:
+            self.errors.append((source, message))
+
+    def progress(self) -> str:
+        return f"scanned {self.scanned}, hashed {self.hashed}"
+
+    def __str__(self) -> str:
+        lines = [f"Found {self.duplicates} duplicates of {self.groups} files, "
+                 f"{self.wasted / 1024 / 1024:.1f} MB wasted, {self.hashed} files hashed"]
+        if self.action == "link":
+            lines.append(f"Replaced by hard links: {self.done}, failed: {self.failed}")
+        elif self.action == "move":
+            lines.append(f"Moved to {DUPLICATES}: {self.done}, failed: {self.failed}")
+        for paths in self.shown:
+            lines.append(paths[0])
+            lines.extend(f"  = {path}" for path in paths[1:])
+        if self.groups > len(self.shown):
+            lines.append(f"... and {self.groups - len(self.shown)} more groups")
+        for source, message in self.errors:
+            lines.append(f"{source}: {message}")
+        if self.failed > len(self.errors):
+            lines.append(f"... and {self.failed - len(self.errors)} more errors")
+        return "\n".join(lines)
+
+
+class DuplicateFinder(FileSorter):
+    """
+    Finds files with equal content: files are grouped by size, then by
+    hash of their first bytes, then by hash of the whole file computed
+    by a process pool. The first file of a group by path is kept,
+    the rest are reported, replaced by hard links or moved away.
+    """
+    def __init__(self, root, workers: int = 4, progress=None, cache: HashCache = None):
+        super().__init__(root, workers, progress)
+        self.cache = cache if cache is not None else HashCache()
+
+    def same_size(self) -> [[(str, tuple)]]:
+        """Groups of (path, stat key) of files having the same size"""
+        counts = {}
+        for entry in scan(self.root, (DUPLICATES,)):
+            self.report.scanned += 1
+            self.notify()
+            try:
+                size = entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                continue
+            if size:
+                counts[size] = counts.get(size, 0) + 1
+
+        # only files which may have a copy are kept in memory
+        groups = {}
+        for entry in scan(self.root, (DUPLICATES,)):
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if counts.get(stat.st_size, 0) > 1:
+                groups.setdefault(stat.st_size, []).append((entry.path, stat_key(stat)))
+        counts.clear()
+
+        result = []
+        for files in groups.values():
+            # hard links of one file take no extra space
+            unique = {}
+            for path, key in sorted(files):
+                unique.setdefault(key[:2], (path, key))
+            if len(unique) > 1:
+                result.append(list(unique.values()))
+        return result
+
+    def split(self, groups: list, full: bool, executor) -> list:
+        """Splits groups by partial or full hash, hashes missing in cache are computed by executor"""
+        missing = [(path, key) for files in groups for path, key in files
+                   if self.cache.get(key, full) is None]
+        if missing:
+            limit = None if full else PARTIAL_SIZE
+            with executor(self.workers) as pool:
+                hashes = pool.map(file_hash, [path for path, key in missing],
+                                  [limit] * len(missing), chunksize=16)
+                for (path, key), value in zip(missing, hashes):
+                    self.report.hashed += 1
+                    if value is not None:
+                        self.cache.set(key, full, value, path)
+                    if self.progress is not None and self.report.hashed % self.PROGRESS_EVERY == 0:
+                        self.progress(self.report)
+
+        result = []
+        for files in groups:
+            same_hash = {}
+            for path, key in files:
+                value = self.cache.get(key, full)
+                if value is not None:
+                    same_hash.setdefault(value, []).append((path, key))
+            result.extend(same for same in same_hash.values() if len(same) > 1)
+        return result
+
+    def changed(self, path: str, key: tuple) -> bool:
+        try:
+            return stat_key(os.stat(path, follow_symlinks=False)) != key
+        except OSError:
+            return True
+
+    def resolve(self, files: [(str, tuple)]) -> None:
+        original, original_key = files[0]
+        for path, key in files[1:]:
+            try:
+                if self.changed(original, original_key) or self.changed(path, key):
+                    raise OSError("changed while checking")
+                if self.report.action == "link":
+                    # the duplicate is replaced at once, never missing
+                    link = path + ".link.tmp"
+                    os.link(original, link)
+                    try:
+                        os.replace(link, path)
+                    except OSError:
+                        os.remove(link)
+                        raise
+                else:
+                    destination = self.destination(DUPLICATES, os.path.basename(path))
+                    os.makedirs(os.path.dirname(destination), exist_ok=True)
+                    os.rename(path, destination)
+            except OSError as error:
+                self.report.fail(path, error.strerror or str(error))
+            else:
+                self.report.done += 1
+
+    @timed()
+    def run(self, action: str = "report") -> DuplicateReport:
+        self.report = DuplicateReport(action)
+        with self.cache.batch():
+            groups = self.same_size()
+            self.cache.touch((key for files in groups for path, key in files), self.root)
+            # reading is the slow part of partial hashes, threads are enough
+            groups = self.split(groups, False, ThreadPoolExecutor)
+            # files not longer than the partial size are fully hashed already
+            small = [files for files in groups if files[0][1][2] <= PARTIAL_SIZE]
+            large = [files for files in groups if files[0][1][2] > PARTIAL_SIZE]
+            groups = small + self.split(large, True, ProcessPoolExecutor)
+
+        for files in groups:
+            self.report.found(files)
+            if action != "report":
+                self.resolve(files)
+        METRICS.count("sorter.files_hashed", self.report.hashed)
+        return self.report
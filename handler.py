@@ -3,8 +3,86 @@ from notebook import *
 from user_config import Config
 from arg_handlers import *
 from abc import abstractmethod, ABC
+from collections.abc import Mapping
+from threading import Lock, Thread
+from time import perf_counter
+import sys
+from metrics import METRICS, timed
 
 config = Config("bot_config.txt")
+METRICS.enabled = config.get("stats", "N").lower() == "y"
+
+def open_target(name: str):
+    """Opens address book or notebook with the storage chosen in config"""
+    unique_phones = config.get("unique_phones", "N").lower() == "y"
+    if config.get("storage", "journal") == "sqlite":
+        # storage and tool modules are imported when used, to keep start up fast
+        from sqlite_store import SqliteAddressBook, SqliteNoteBook
+        if name == "contacts":
+            return SqliteAddressBook(config.get("addressbook_db", "phone_book.db"), unique_phones)
+        return SqliteNoteBook(config.get("notebook_db", "notes.db"))
+    if name == "contacts":
+        return AddressBook(config["addressbook_file"], unique_phones)
+    return NoteBook(config["notebook_file"])
+
+
+class Targets(Mapping):
+    """
+    Address book and notebook opened on first use
+    or loaded by a background thread right after start
+    """
+    NAMES = ("contacts", "notes")
+
+    def __init__(self, opener=open_target):
+        self.opener = opener
+        self.data = {}
+        self.timings = {}  # name: seconds spent opening
+        self._locks = {name: Lock() for name in self.NAMES}
+
+    def __getitem__(self, name: str):
+        target = self.data.get(name)
+        if target is None:
+            with self._locks[name]:
+                target = self.data.get(name)
+                if target is None:
+                    start = perf_counter()
+                    target = self.opener(name)
+                    self.timings[name] = perf_counter() - start
+                    self.data[name] = target
+        return target
+
+    def __iter__(self):
+        return iter(self.NAMES)
+
+    def __len__(self) -> int:
+        return len(self.NAMES)
+
+    def loaded(self) -> list:
+        """Targets already opened, without opening the rest"""
+        return list(self.data.values())
+
+    def prefetch(self) -> Thread:
+        thread = Thread(target=self._prefetch, name="prefetch", daemon=True)
+        thread.start()
+        return thread
+
+    def _prefetch(self) -> None:
+        for name in self.NAMES:
+            try:
+                self[name]
+            except Exception:
+                # the error is raised again when the target is really used
+                pass
+
+    def report(self) -> str:
+        lines = []
+        for name in self.NAMES:
+            if name in self.timings:
+                lines.append(f"{name}: opened in {self.timings[name] * 1000:.1f} ms, "
+                             f"{len(self.data[name])} records")
+            else:
+                lines.append(f"{name}: not opened")
+        return "\n".join(lines)
 
 def input_error(handler):
     
@@ -37,6 +115,14 @@ class Command(ABC):
     args_handlers = None
     success = False
     name = None
+    changes_data = False  # command modifies the target
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # every command's execute is timed under its class name
+        execute = cls.__dict__.get("execute")
+        if execute is not None and not getattr(execute, "__isabstractmethod__", False):
+            cls.execute = timed(f"command.{cls.__name__}")(execute)
 
     def set_args(self):
         return None
@@ -63,7 +149,21 @@ class ExitCommand(Command):
 class TargetCommand(Command):
     target: Target = None
     record = None
+    session = None  # CommandCreator that keeps the user's target and listing
+    target_record = None  # Record or Note of the only target the command works with
     _args = {}
+
+    def unavailable(self) -> str:
+        """Message if the chosen target has no such command, None if it has"""
+        if self.target_record is None or self.record is self.target_record:
+            return None
+        # nothing to ask for, the command is over
+        self.success = True
+        if self.record is Record:
+            return "Not available for contacts"
+        if self.record is Note:
+            return "Not available for notes"
+        return "Choose contacts or notes first"
     
     def set_args(self, value):
         for key in self._args:
@@ -75,7 +175,7 @@ class TargetCommand(Command):
         args = dict(self._args)
         try:
             for name, value in self._args.items():
-                args[name] = self.args_handlers.handle({name: value})
+                args[name] = self.args_handlers.validate(name, value)
         except Exception as e:
             self._args[name] = None
             raise ValueError(str(e))
@@ -86,6 +186,7 @@ class TargetCommand(Command):
         super().execute()
 
 class AddCommand(TargetCommand):
+    changes_data = True
     @input_error
     def execute(self) -> str:
         """Add new record to contact list"""
@@ -97,6 +198,7 @@ class AddCommand(TargetCommand):
         return message
 
 class DeleteCommand(TargetCommand):
+    changes_data = True
     @input_error
     def execute(self) -> str:
         self.handle_args()
@@ -113,9 +215,58 @@ class FindCommand(TargetCommand):
         """Searching contacts by given string"""
 
         args = self.handle_args()
-        records = [str(cnt) for cnt in self.target.find(*args)]
+        per_page = int(config["records_per_page"])
+        if self.record is Record:
+            # only contacts of the shown page are read
+            names = self.target.find_names(*args)
+            pagination = Pagination.from_keys(names, self.target.get, per_page)
+        else:
+            pagination = Pagination.from_list(self.target.find(*args), per_page)
+        if pagination.count():
+            self.session.pagination = pagination
+            message = next(pagination)
+        else:
+            message = "Didn't find anything!"
+        super().execute()
+        return message
+
+
+class SearchTextCommand(TargetCommand):
+    _args = {"search": None}
+    target_record = Note
+
+    @input_error
+    def execute(self) -> str:
+        """Full-text search in notes, most relevant first"""
+        message = self.unavailable()
+        if message:
+            return message
+        args = self.handle_args()
+        notes = self.target.search(*args)
+        if notes:
+            self.session.pagination = Pagination.from_list(notes, int(config["records_per_page"]))
+            message = next(self.session.pagination)
+        else:
+            message = "Didn't find anything!"
+        super().execute()
+        return message
+
+
+class FuzzyFindCommand(TargetCommand):
+    _args = {"search": None}
+    target_record = Record
+
+    @input_error
+    def execute(self) -> str:
+        """Contacts whose names are close to the given one, fewest typos first"""
+        message = self.unavailable()
+        if message:
+            return message
+        args = self.handle_args()
+        records = self.target.find_fuzzy(*args)
         if records:
-            message = "\n".join(records)
+            self.session.pagination = Pagination.from_list(records, int(config["records_per_page"]))
+            message = next(self.session.pagination)
         else:
             message = "Didn't find anything!"
         super().execute()
@@ -123,6 +274,7 @@ class FindCommand(TargetCommand):
 
 
 class AddPhoneCommand(TargetCommand):
+    changes_data = True
     _args = {
             "name": None,
             "phone": None
@@ -131,7 +283,7 @@ class AddPhoneCommand(TargetCommand):
         args = dict(self._args)
         try:
             for name, value in self._args.items():
-                args[name] = self.args_handlers.handle({name: value})
+                args[name] = self.args_handlers.validate(name, value)
                 if self._args["name"] not in self.target:
                     raise ValueError("No such record")
         except Exception as e:
@@ -151,6 +303,7 @@ class AddPhoneCommand(TargetCommand):
     
 
 class DelPhoneCommand(TargetCommand):
+    changes_data = True
     _args = {
             "name": None,
             "phone": None
@@ -159,7 +312,7 @@ class DelPhoneCommand(TargetCommand):
         args = dict(self._args)
         try:
             for name, value in self._args.items():
-                args[name] = self.args_handlers.handle({name: value})
+                args[name] = self.args_handlers.validate(name, value)
                 if self._args["name"] not in self.target:
                     raise ValueError("No such record")
         except Exception as e:
@@ -179,6 +332,7 @@ class DelPhoneCommand(TargetCommand):
     
     
 class AddTagsCommand(TargetCommand):
+    changes_data = True
     _args = {
             "id": None,
             "tags": None
@@ -187,7 +341,7 @@ class AddTagsCommand(TargetCommand):
         args = dict(self._args)
         try:
             for name, value in self._args.items():
-                args[name] = self.args_handlers.handle({name: value})
+                args[name] = self.args_handlers.validate(name, value)
                 if self._args["id"] not in self.target:
                     raise ValueError("No such record")
         except Exception as e:
@@ -207,6 +361,7 @@ class AddTagsCommand(TargetCommand):
     
 
 class DelTagCommand(TargetCommand):
+    changes_data = True
     _args = {
             "id": None,
             "tag": None
@@ -215,7 +370,7 @@ class DelTagCommand(TargetCommand):
         args = dict(self._args)
         try:
             for name, value in self._args.items():
-                args[name] = self.args_handlers.handle({name: value})
+                args[name] = self.args_handlers.validate(name, value)
                 if self._args["id"] not in self.target:
                     raise ValueError("No such record")
         except Exception as e:
@@ -241,39 +396,199 @@ class ShowCommand(TargetCommand):
         If not any parameter given shows all contacts
         return str in phormat:
         """
-        if self.target == {}:
+        if not self.target:
             return "You have no notes yet"
         
-        self.target.pagination = self.target.iterator(records_per_page=int(config["records_per_page"]))
-        message = next(self.target.pagination)
+        self.session.pagination = self.target.iterator(records_per_page=int(config["records_per_page"]))
+        message = next(self.session.pagination)
         super().execute()
         return message
 
 
 class DtbCommand(TargetCommand):
     _args = {"name": None}
+    target_record = Record
     
     @input_error
     def execute(self):
+        message = self.unavailable()
+        if message:
+            return message
         self.handle_args()
-        days = None
-        contact = self.target[self._args["name"]]
-        if not contact:
-            return "No such contact"
-        days = contact.days_to_birthday()
+        days = self.target.days_to_birthday(self._args["name"])
         super().execute()
-        if days:
+        if days is not None:
             return str(days)
         else:
             return ""
 
+
+class SbsCommand(TargetCommand):
+    target_record = Record
+
+    @input_error
+    def execute(self):
+        """Shows contacts with birthday in the next given days"""
+        message = self.unavailable()
+        if message:
+            return message
+        days, = self.handle_args()
+        upcoming = self.target.upcoming_birthdays(days)
+        super().execute()
+        if not upcoming:
+            return f"No birthdays in the next {days} days"
+        lines = []
+        for days_left, record in upcoming:
+            if days_left == 0:
+                when = "today"
+            elif days_left == 1:
+                when = "tomorrow"
+            else:
+                when = f"in {days_left} days"
+            lines.append(f"{record.name.value}: {when} ({record.birthday})")
+        return "\n".join(lines)
+
+class TopTagsCommand(TargetCommand):
+    TOP_COUNT = 10
+    TOGETHER_COUNT = 3
+    target_record = Note
+
+    @input_error
+    def execute(self):
+        """Shows the most used tags and the tags used with them"""
+        message = self.unavailable()
+        if message:
+            return message
+        lines = []
+        for tag, count in self.target.top_tags(self.TOP_COUNT):
+            line = f"{tag}: {count}"
+            together = self.target.tags_together_with(tag, self.TOGETHER_COUNT)
+            if together:
+                line += " (with " + ", ".join(f"{other}: {n}" for other, n in together) + ")"
+            lines.append(line)
+        super().execute()
+        if not lines:
+            return "You have no tags yet"
+        return "\n".join(lines)
+
+class FileCommand(TargetCommand):
+    def unavailable(self) -> str:
+        # both targets have files, but one must be chosen
+        if self.record is None:
+            self.success = True
+            return "Choose contacts or notes first"
+        return super().unavailable()
+
+    def handle_args(self):
+        from bulk import get_format
+        args = super().handle_args()
+        try:
+            get_format(self.record, args[0])
+        except (ValueError, KeyError):
+            for name in self._args:
+                self._args[name] = None
+            raise
+        return args
+
+
+class ImportCommand(FileCommand):
+    changes_data = True
+
+    @input_error
+    def execute(self):
+        """Adds records from csv, jsonl or vcard file"""
+        message = self.unavailable()
+        if message:
+            return message
+        from bulk import import_records
+        file_name, = self.handle_args()
+        report = import_records(self.target, self.record, file_name)
+        super().execute()
+        return str(report)
+
+
+class ExportCommand(FileCommand):
+    @input_error
+    def execute(self):
+        """Writes all records to csv, jsonl or vcard file"""
+        message = self.unavailable()
+        if message:
+            return message
+        from bulk import export_records
+        file_name, = self.handle_args()
+        count = export_records(self.target, self.record, file_name)
+        super().execute()
+        return f"{count} records were exported to {file_name}"
+
+
+class StatsCommand(Command):
+    def execute(self) -> str:
+        """Latencies and sizes collected since start"""
+        super().execute()
+        if not METRICS.enabled:
+            return "Statistics are off, set stats=Y in bot_config.txt or start with --stats"
+        return METRICS.report() or "Nothing measured yet"
+
+
+class SaveStatsCommand(TargetCommand):
+    _args = {"stats file": None}
+
+    @input_error
+    def execute(self) -> str:
+        """Writes statistics as JSON or Prometheus text"""
+        file_name, = self.handle_args()
+        METRICS.save(file_name)
+        super().execute()
+        return f"Statistics were saved to {file_name}"
+
+
+class SortFilesCommand(TargetCommand):
+    _args = {"folder": None, "dry run": None}
+
+    @input_error
+    def execute(self) -> str:
+        """Moves files of the folder into images, video, documents, audio, archives and other"""
+        from file_sorter import FileSorter
+        folder, dry_run = self.handle_args()
+        sorter = FileSorter(folder, int(config.get("sorter_workers", "4")), print_progress)
+        report = sorter.run(dry_run)
+        super().execute()
+        return str(report)
+
+
+class FindDuplicatesCommand(TargetCommand):
+    _args = {"folder": None, "duplicates action": None}
+
+    @input_error
+    def execute(self) -> str:
+        """Finds files with the same content, can hard link them or move to duplicates folder"""
+        from file_sorter import DuplicateFinder, HashCache
+        folder, action = self.handle_args()
+        cache = HashCache(config.get("hash_cache", "file_hashes.bin"))
+        try:
+            finder = DuplicateFinder(folder, int(config.get("sorter_workers", "4")), print_progress, cache)
+            report = finder.run(action)
+        finally:
+            cache.close()
+        super().execute()
+        return str(report)
+
+
+def print_progress(report) -> None:
+    print(f"Sorting files: {report.progress()}", file=sys.stderr)
+
+
 class NextCommand(TargetCommand):
+    @input_error
     def execute(self):
         """Using for listing addressbook"""
+        if self.session.pagination is None:
+            super().execute()
+            return "Nothing to list yet, use 'show' or 'find' first"
         try:
-            message = next(self.target.pagination)
+            message = next(self.session.pagination)
         except StopIteration:
-            message = "You have reached the end of the addressbook"
+            message = "You have reached the end of the list"
         
         super().execute()
         return message
@@ -284,10 +599,7 @@ class UnknownCommand(Command):
         return "Unknown command"
     
 class CommandCreator:
-    targets = {
-                "contacts": AddressBook(config["addressbook_file"]),
-                "notes": NoteBook(config["notebook_file"]),
-                }
+    targets = Targets()
     records = {
                 "contacts": Record,
                 "notes": Note
@@ -296,87 +608,113 @@ class CommandCreator:
                 "add": AddCommand, 
                 "delete": DeleteCommand, 
                 "find": FindCommand, 
+                "search": SearchTextCommand,
+                "fuzzy": FuzzyFindCommand,
                 "del phone": DelPhoneCommand, 
                 "add phone": AddPhoneCommand,
                 "del tag": DelTagCommand, 
                 "add tags": AddTagsCommand, 
+                "top tags": TopTagsCommand,
                 "show": ShowCommand,
                 "next": NextCommand,
                 "exit": ExitCommand,
                 "good bye": ExitCommand,
                 "close": ExitCommand,
                 "dtb": DtbCommand,
-                "sort files": "6",
+                "sbs": SbsCommand,
+                "import": ImportCommand,
+                "export": ExportCommand,
+                "stats": StatsCommand,
+                "save stats": SaveStatsCommand,
+                "sort files": SortFilesCommand,
+                "file sorter": SortFilesCommand,
+                "find duplicates": FindDuplicatesCommand,
                 "unknown": UnknownCommand,
                 }
-    args_handlers = None
+    args_handlers = Validator()
 
-    def set_handlers(self, command: Command):
-        if self.args_handlers is not None:
-            command.args_handlers = self.args_handlers
-            return True
-        
-        self.args_handlers = NameHandler()
-        self.args_handlers.set_next(PhoneHandler())\
-                                    .set_next(BirthdayHandler())\
-                                    .set_next(EmailHandler())\
-                                    .set_next(TextHadnler())\
-                                    .set_next(TagsHandler())\
-                                    .set_next(FolderHandler())\
-                                    .set_next(IdHandler())\
-                                    .set_next(SearchHandler())\
-                                    .set_next(IntersecHandler())\
-                                    .set_next(FieldHandler())\
-                                    .set_next(TagHandler())
+    def __init__(self):
+        # state of one user: chosen target and the listing being paged
+        self.target = None
+        self.record = None
+        self.pagination = None
 
+    def set_handlers(self, command: Command):
         command.args_handlers = self.args_handlers
         return True
     
     def set_args(self, cmd: Command):
         if cmd.name in ("add", "edit"):
-            if isinstance(cmd.target, AddressBook):
+            if cmd.record is Record:
                 cmd._args = {
                             "name": None,
                             "phone": None,
                             "birthday": None,
                             "email": None,
                             }
-            elif isinstance(cmd.target, NoteBook):
+            elif cmd.record is Note:
                 cmd._args = {
                             "text": None,
                             "tags": None,
                             }
         elif cmd.name == "delete":
-            if isinstance(cmd.target, AddressBook):
+            if cmd.record is Record:
                 cmd._args = {
                             "name": None
                             }
-            elif isinstance(cmd.target, NoteBook):
+            elif cmd.record is Note:
                 cmd._args = {
                             "id": None
                             }
         elif cmd.name == "find":
-            if isinstance(cmd.target, AddressBook):
+            if cmd.record is Record:
                 cmd._args = {
                             "search": None
                             }
-            elif isinstance(cmd.target, NoteBook):
+            elif cmd.record is Note:
                 cmd._args = {
                             "tags": None,
                             "intersec": None, 
                             }
+        elif cmd.name == "search":
+            cmd._args = {
+                        "search": None
+                        }
+        elif cmd.name == "import":
+            cmd._args = {
+                        "import file": None
+                        }
+        elif cmd.name == "export":
+            cmd._args = {
+                        "export file": None
+                        }
+        elif cmd.name == "sbs":
+            cmd._args = {
+                        "days": None
+                        }
     def set_target(self, target: str):
-        TargetCommand.target = self.targets[target]
-        TargetCommand.record = self.records[target]
+        self.target = self.targets[target]
+        self.record = self.records[target]
+        self.pagination = None
     
+    @timed("CommandCreator.create")
     def create(self, command: str):
         if command in ("notes", "contacts"):
             self.set_target(command)
+        if self.target is not None:
+            # another process may have saved changes since the last command
+            self.target.refresh()
         cmd: Command = self.commands.get(command)
         if not cmd:
             cmd = self.commands.get("unknown")
         cmd = cmd()
         cmd.name = command
+        cmd.target = self.target
+        cmd.record = self.record
+        cmd.session = self
+        if cmd._args is not None:
+            # every command collects its own arguments
+            cmd._args = dict.fromkeys(cmd._args)
         self.set_handlers(cmd)
         self.set_args(cmd)
         
@@ -0,0 +1,485 @@
+#########################
+#----In-memory indexes--#
+#########################
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+from calendar import isleap
+from datetime import date, timedelta
+from heapq import nlargest
+from math import log
+from re import findall
+from unicodedata import combining, normalize
+
+
+def normalize_key(text: str) -> str:
+    """
+    Search key of a text: NFKC compatible forms, casefolded,
+    without accents. Computed when records are written, so
+    queries compare keys without touching the records
+    """
+    if text.isascii():
+        return text.lower()
+    text = normalize("NFKD", text.casefold())
+    return normalize("NFC", "".join(char for char in text if not combining(char)))
+
+
+def normalize_tag(tag: str) -> str:
+    """Key of a tag: "#Tag", "tag" and "##TAG" are the same tag"""
+    return normalize_key(tag.strip().lstrip("#"))
+
+
+class InvertedIndex:
+    """
+    Maps terms to the set of record keys they were indexed for
+    """
+    def __init__(self):
+        self.postings = {}  # term -> set of keys
+        self.terms = {}  # key -> set of terms indexed for it
+
+    def add(self, key, terms: set) -> None:
+        old_terms = self.terms.get(key, set())
+        self.unpost(key, old_terms - terms)
+        self.post(key, terms - old_terms)
+        self.terms[key] = terms
+
+    def post(self, key, terms) -> None:
+        for term in terms:
+            self.postings.setdefault(term, set()).add(key)
+
+    def unpost(self, key, terms) -> None:
+        for term in terms:
+            keys = self.postings.get(term)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del self.postings[term]
+
+    def remove(self, key) -> None:
+        if key in self.terms:
+            self.add(key, set())
+            del self.terms[key]
+
+    def get(self, term) -> set:
+        return self.postings.get(term, set())
+
+    def intersection(self, terms) -> set:
+        """Keys indexed for all of the terms, smallest posting first"""
+        postings = sorted((self.get(term) for term in terms), key=len)
+        if not postings:
+            return set()
+        result = set(postings[0])
+        for keys in postings[1:]:
+            if not result:
+                break
+            result.intersection_update(keys)
+        return result
+
+    def union(self, terms) -> set:
+        """Keys indexed for any of the terms"""
+        result = set()
+        for term in terms:
+            result.update(self.get(term))
+        return result
+
+    def clear(self) -> None:
+        self.postings.clear()
+        self.terms.clear()
+
+
+class TrigramIndex(InvertedIndex):
+    """
+    Inverted index from every 3-character substring to the keys
+    whose texts contain it. Used to narrow substring search candidates.
+    Grams of a key are not kept, the caller gives its old texts back
+    and they are split again.
+    """
+    N = 3
+
+    @classmethod
+    def split(cls, text: str) -> set:
+        return {text[i: i + cls.N] for i in range(len(text) - cls.N + 1)}
+
+    def grams(self, texts) -> set:
+        grams = set()
+        for text in texts:
+            grams.update(self.split(text))
+        return grams
+
+    def add(self, key, texts, old_texts=()) -> None:
+        grams = self.grams(texts)
+        old_grams = self.grams(old_texts)
+        self.unpost(key, old_grams - grams)
+        self.post(key, grams - old_grams)
+
+    def remove(self, key, texts=()) -> None:
+        self.unpost(key, self.grams(texts))
+
+    def candidates(self, search: str):
+        """Returns keys that may contain search, None if it is too short to tell"""
+        if len(search) < self.N:
+            return None
+        return self.intersection(self.split(search))
+
+
+def edit_distance(a: str, b: str) -> int:
+    """
+    Levenshtein distance, bit-parallel (Myers, Hyyro):
+    one column of the distance matrix per character of a
+    """
+    if a == b:
+        return 0
+    if len(a) < len(b):
+        a, b = b, a
+    if not b:
+        return len(a)
+    positions = {}  # char -> bit mask of its positions in b
+    bit = 1
+    for char in b:
+        positions[char] = positions.get(char, 0) | bit
+        bit <<= 1
+    mask = bit - 1
+    last = bit >> 1
+    plus, minus = mask, 0  # vertical deltas +1 and -1
+    score = len(b)
+    for char in a:
+        equal = positions.get(char, 0)
+        x_vertical = equal | minus
+        x_horizontal = (((equal & plus) + plus) ^ plus) | equal
+        h_plus = minus | ~(x_horizontal | plus)
+        h_minus = plus & x_horizontal
+        if h_plus & last:
+            score += 1
+        elif h_minus & last:
+            score -= 1
+        h_plus = (h_plus << 1) | 1
+        plus = ((h_minus << 1) | ~(x_vertical | h_plus)) & mask
+        minus = h_plus & x_vertical
+    return score
+
+
+class BKTree(InvertedIndex):
+    """
+    Inverted index whose terms are also kept in a BK-tree, so terms
+    within an edit distance from a query are found without
+    measuring the distance to every term.
+    Swapping two neighbour characters counts as one typo.
+    """
+    def __init__(self):
+        super().__init__()
+        self.root = None  # (term, {distance: child node})
+        self.size = 0  # terms in the tree, removed ones included
+
+    def add(self, key, terms: set) -> None:
+        new_terms = [term for term in terms if term not in self.postings]
+        super().add(key, terms)
+        for term in new_terms:
+            self._insert(term)
+        if self.size > 2 * len(self.postings) + 1000:
+            self._rebuild()
+
+    def _insert(self, term: str) -> None:
+        if self.root is None:
+            self.root = (term, {})
+            self.size = 1
+            return
+        node = self.root
+        while True:
+            distance = edit_distance(term, node[0])
+            if distance == 0:
+                # removed earlier and now used again
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (term, {})
+                self.size += 1
+                return
+            node = child
+
+    def _rebuild(self) -> None:
+        # drop terms no key uses any more
+        self.root = None
+        self.size = 0
+        for term in self.postings:
+            self._insert(term)
+
+    def search(self, term: str, max_distance: int) -> [(int, str)]:
+        """(distance, key) pairs within max_distance, closest first"""
+        found = {}
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node_term, children = nodes.pop()
+            distance = edit_distance(term, node_term)
+            if distance <= max_distance:
+                for key in self.postings.get(node_term, ()):
+                    if distance < found.get(key, max_distance + 1):
+                        found[key] = distance
+            # triangle inequality: only these subtrees can hold close terms
+            for child_distance in range(max(1, distance - max_distance), distance + max_distance + 1):
+                child = children.get(child_distance)
+                if child is not None:
+                    nodes.append(child)
+        if max_distance:
+            for i in range(len(term) - 1):
+                swapped = term[:i] + term[i + 1] + term[i] + term[i + 2:]
+                for key in self.postings.get(swapped, ()):
+                    if found.get(key, 2) > 1:
+                        found[key] = 1
+        return sorted((distance, key) for key, distance in found.items())
+
+    def clear(self) -> None:
+        super().clear()
+        self.root = None
+        self.size = 0
+
+
+class HashIndex(InvertedIndex):
+    """
+    Exact value lookup. With unique=True a value may belong to one key only.
+    """
+    def __init__(self, unique: bool=False):
+        super().__init__()
+        self.unique = unique
+
+    def check(self, key, terms) -> None:
+        if not self.unique:
+            return
+        for term in terms:
+            owners = self.postings.get(term)
+            if owners and owners != {key}:
+                owner = next(iter(owners - {key}))
+                raise ValueError(f"{term} already belongs to {owner}")
+
+
+class SortedKeys:
+    """
+    Record keys kept in sort order, so a listing can resume after any key
+    """
+    def __init__(self, sort_key=None):
+        self.sort_key = sort_key
+        self.items = []  # sorted (sort key, key)
+
+    def _item(self, key) -> tuple:
+        return (self.sort_key(key) if self.sort_key else key, key)
+
+    def add(self, key) -> None:
+        item = self._item(key)
+        i = bisect_left(self.items, item)
+        if i == len(self.items) or self.items[i] != item:
+            self.items.insert(i, item)
+
+    def remove(self, key) -> None:
+        item = self._item(key)
+        i = bisect_left(self.items, item)
+        if i < len(self.items) and self.items[i] == item:
+            del self.items[i]
+
+    def reset(self, keys) -> None:
+        self.items = sorted(self._item(key) for key in keys)
+
+    def after(self, key=None):
+        """Keys following the given one, from the first if key is None"""
+        i = 0 if key is None else bisect_right(self.items, self._item(key))
+        while i < len(self.items):
+            yield self.items[i][1]
+            i += 1
+
+    def clear(self) -> None:
+        self.items.clear()
+
+
+class TagStats:
+    """
+    Reference count of every tag and of every pair of tags used together
+    """
+    def __init__(self):
+        self.counts = Counter()
+        self.pairs = {}  # tag -> Counter of tags seen together with it
+
+    def update(self, old_tags: set, new_tags: set) -> None:
+        """Moves one note from old_tags to new_tags"""
+        for tag in old_tags - new_tags:
+            self._count(tag, old_tags, new_tags, -1)
+        for tag in new_tags - old_tags:
+            self._count(tag, new_tags, old_tags, 1)
+
+    def _count(self, tag: str, tags: set, other_tags: set, delta: int) -> None:
+        self.counts[tag] += delta
+        if not self.counts[tag]:
+            del self.counts[tag]
+        for other in tags:
+            if other == tag:
+                continue
+            self._count_pair(tag, other, delta)
+            if other in other_tags:
+                # the other side of the pair is not counted by its own loop
+                self._count_pair(other, tag, delta)
+
+    def _count_pair(self, tag: str, other: str, delta: int) -> None:
+        counter = self.pairs.setdefault(tag, Counter())
+        counter[other] += delta
+        if not counter[other]:
+            del counter[other]
+            if not counter:
+                del self.pairs[tag]
+
+    def top(self, count: int=None) -> [(str, int)]:
+        return self.counts.most_common(count)
+
+    def together_with(self, tag: str, count: int=None) -> [(str, int)]:
+        return self.pairs.get(tag, Counter()).most_common(count)
+
+    def clear(self) -> None:
+        self.counts.clear()
+        self.pairs.clear()
+
+
+class TextIndex:
+    """
+    Full-text index with term frequencies, ranks results by BM25
+    """
+    K1 = 1.2
+    B = 0.75
+    VERSION = 2  # changes when tokenize does, saved indexes are rebuilt
+
+    def __init__(self):
+        self.version = self.VERSION
+        self.postings = {}  # term -> {key: term frequency}
+        self.terms = {}  # key -> terms indexed for it
+        self.lengths = {}  # key -> number of terms
+        self.total_length = 0
+
+    @staticmethod
+    def tokenize(text: str) -> [str]:
+        return findall(r"\w+", normalize_key(text))
+
+    def add(self, key, text: str) -> None:
+        self.remove(key)
+        terms = Counter(self.tokenize(text))
+        for term, frequency in terms.items():
+            self.postings.setdefault(term, {})[key] = frequency
+        self.terms[key] = tuple(terms)
+        length = sum(terms.values())
+        self.lengths[key] = length
+        self.total_length += length
+
+    def remove(self, key) -> None:
+        if key not in self.terms:
+            return
+        for term in self.terms.pop(key):
+            keys = self.postings[term]
+            del keys[key]
+            if not keys:
+                del self.postings[term]
+        self.total_length -= self.lengths.pop(key)
+
+    def search(self, query: str, count: int=None) -> [(float, object)]:
+        """(score, key) pairs for keys containing any of the query terms, best first"""
+        if not self.lengths:
+            return []
+        docs_count = len(self.lengths)
+        avg_length = self.total_length / docs_count
+        scores = {}
+        for term in set(self.tokenize(query)):
+            keys = self.postings.get(term)
+            if not keys:
+                continue
+            idf = log(1 + (docs_count - len(keys) + 0.5) / (len(keys) + 0.5))
+            for key, frequency in keys.items():
+                norm = self.K1 * (1 - self.B + self.B * self.lengths[key] / avg_length)
+                score = idf * frequency * (self.K1 + 1) / (frequency + norm)
+                scores[key] = scores.get(key, 0) + score
+        results = ((score, key) for key, score in scores.items())
+        if count is None:
+            return sorted(results, reverse=True)
+        return nlargest(count, results)
+
+    def clear(self) -> None:
+        self.postings.clear()
+        self.terms.clear()
+        self.lengths.clear()
+        self.total_length = 0
+
+
+def next_birthday(month: int, day: int, today: date) -> date:
+    """Next date of the birthday counting from today, 29 February falls on 1 March in common years"""
+    year = today.year
+    while True:
+        if month == 2 and day == 29 and not isleap(year):
+            birthday = date(year, 3, 1)
+        else:
+            birthday = date(year, month, day)
+        if birthday >= today:
+            return birthday
+        year += 1
+
+
+class BirthdayIndex:
+    """
+    Record keys sorted by day of year of the birthday.
+    Days are counted in a leap year so 29 February has its own place.
+    """
+    LEAP_YEAR = 2000
+
+    def __init__(self):
+        self.keys = []  # sorted (day of year, key)
+        self.days = {}  # key -> day of year
+
+    @classmethod
+    def day_of_year(cls, month: int, day: int) -> int:
+        return date(cls.LEAP_YEAR, month, day).timetuple().tm_yday
+
+    @classmethod
+    def month_day(cls, day_of_year: int) -> (int, int):
+        day = date(cls.LEAP_YEAR, 1, 1) + timedelta(days=day_of_year - 1)
+        return day.month, day.day
+
+    def add(self, key, birthday: date) -> None:
+        self.remove(key)
+        if birthday is None:
+            return
+        day = self.day_of_year(birthday.month, birthday.day)
+        insort(self.keys, (day, key))
+        self.days[key] = day
+
+    def remove(self, key) -> None:
+        day = self.days.pop(key, None)
+        if day is not None:
+            del self.keys[bisect_left(self.keys, (day, key))]
+
+    def clear(self) -> None:
+        self.keys.clear()
+        self.days.clear()
+
+    def range(self, first: int, last: int) -> list:
+        start = bisect_left(self.keys, (first,))
+        stop = bisect_left(self.keys, (last + 1,))
+        return self.keys[start: stop]
+
+    def days_to_birthday(self, key, today: date) -> int:
+        if key not in self.days:
+            return None
+        birthday = next_birthday(*self.month_day(self.days[key]), today)
+        return (birthday - today).days
+
+    def upcoming(self, today: date, days: int) -> [(int, object)]:
+        """Keys with birthday in the next days, as (days left, key) pairs"""
+        result = []
+        seen = set()
+        start = today
+        end = today + timedelta(days=min(days, 365))
+        while start <= end:
+            segment_end = min(end, date(start.year, 12, 31))
+            first = self.day_of_year(start.month, start.day)
+            last = self.day_of_year(segment_end.month, segment_end.day)
+            if not isleap(start.year) and (start.month, start.day) == (3, 1):
+                first -= 1  # 29 February is celebrated today
+            for day, key in self.range(first, last):
+                if key in seen:
+                    continue
+                seen.add(key)
+                birthday = next_birthday(*self.month_day(day), start)
+                result.append(((birthday - today).days, key))
+            start = segment_end + timedelta(days=1)
+
+        return result
@@ -26,4 +26,42 @@ class ConsoleUserInterface(UserInterface):
     def data_output(self, data):
         print(data)
 
-        
\ No newline at end of file
+        
+
+
+class Session:
+    """
+    Dialog of one user: menu position, chosen target
+    and the command waiting for its arguments
+    """
+    def __init__(self, menu: Menu, handler):
+        self.menu = menu
+        self.handler = handler
+        self.command = None
+
+    def changes_data(self, user_data: str) -> bool:
+        """Whether handling user_data may modify a target"""
+        command = self.command
+        if command is None:
+            command = self.handler.commands.get(user_data)
+        return getattr(command, "changes_data", False)
+
+    def respond(self, user_data: str) -> str:
+        output_data = ""
+        if self.command is None:
+            output_data = self.menu.navigate(user_data)
+            try:
+                self.command = self.handler.create(user_data)
+            except ValueError as error:
+                # e.g. the address book file is damaged
+                return str(error)
+        else:
+            self.command.set_args(user_data)
+        
+        result = self.command.execute()
+        if self.command.success:
+            self.command = None
+        if not output_data:
+            output_data = result
+
+        return output_data
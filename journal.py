@@ -0,0 +1,869 @@
+import mmap
+import os
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from contextlib import contextmanager, nullcontext
+from threading import Lock
+from pickle import dumps, loads, load, HIGHEST_PROTOCOL
+from struct import Struct
+from metrics import METRICS, timed
+
+FRAME = Struct(">I")  # length prefix of entries in version 1 snapshots and old logs
+LOG_MAGIC = b"SBL2"
+LOG_FRAME = Struct(">III")  # payload length, payload crc32 and crc32 of the two
+
+SNAPSHOT_VERSION = 2
+# magic, format version, codec, number of records, directory offset, length and crc32
+HEADER = Struct(">4sHBxIQQI")
+HEADER_CRC = Struct(">I")
+NO_CODEC, ZLIB = 0, 1
+# records are small, so they are compressed with a dictionary made of the first ones
+ZDICT_SAMPLE = 200
+ZDICT_SIZE = 4096
+WBITS = -12  # raw deflate with a window as big as the dictionary
+MEM_LEVEL = 4
+
+try:
+    from fcntl import flock, LOCK_EX, LOCK_SH, LOCK_UN
+
+    def lock_file(fd: int, shared: bool = False) -> None:
+        flock(fd, LOCK_SH if shared else LOCK_EX)
+
+    def unlock_file(fd: int) -> None:
+        flock(fd, LOCK_UN)
+except ImportError:
+    from msvcrt import locking, LK_LOCK, LK_UNLCK
+
+    def lock_file(fd: int, shared: bool = False) -> None:
+        # there are no shared locks here, readers take turns with writers
+        os.lseek(fd, 0, os.SEEK_SET)
+        locking(fd, LK_LOCK, 1)
+
+    def unlock_file(fd: int) -> None:
+        os.lseek(fd, 0, os.SEEK_SET)
+        locking(fd, LK_UNLCK, 1)
+
+
+def dump_entry(key, value) -> bytes:
+    return dumps((key, value), HIGHEST_PROTOCOL)
+
+
+def load_entry(payload: bytes):
+    return loads(payload)
+
+
+def legacy_load(f) -> dict:
+    # files written before the journal are a bare pickle of the records dict
+    return load(f)
+
+
+class CorruptedFile(ValueError):
+    """The file can't be read back as it was written"""
+
+
+class Snapshot:
+    """
+    Snapshot file opened for reading. A checksummed header points to the
+    directory of keys, block positions and index data of every record;
+    blocks are compressed one per record and read through mmap on demand.
+    """
+    MAGIC = b"SBJ2"
+
+    def __init__(self, f, load_entry=load_entry):
+        self.name = f.name
+        self.load_entry = load_entry
+        size = os.fstat(f.fileno()).st_size
+        if size < HEADER.size + HEADER_CRC.size:
+            raise CorruptedFile(f"{self.name} is damaged: the file is truncated")
+        self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = self.mmap[:HEADER.size]
+        crc, = HEADER_CRC.unpack_from(self.mmap, HEADER.size)
+        if zlib.crc32(header) != crc:
+            raise CorruptedFile(f"{self.name} is damaged: wrong header checksum")
+        magic, self.format, self.codec, self.count, offset, length, crc = HEADER.unpack(header)
+        if self.format > SNAPSHOT_VERSION or self.codec not in (NO_CODEC, ZLIB):
+            raise CorruptedFile(f"{self.name} is written by a newer version of the bot")
+        if offset + length > size:
+            raise CorruptedFile(f"{self.name} is damaged: the file is truncated")
+        self.directory = offset, length, crc
+        self.directory_size = length
+        self.zdict, entries = self.read_directory()
+        self.positions = {}  # key: (offset, length, crc32, unpacked size) of its block
+        self.metas = {}  # key: index data, given away once
+        self.data_size = 0  # bytes of all records unpacked
+        for key, offset, length, crc, size, meta in entries:
+            self.positions[key] = offset, length, crc, size
+            self.metas[key] = meta
+            self.data_size += size
+
+    def read_directory(self) -> (bytes, list):
+        offset, length, crc = self.directory
+        data = self.mmap[offset: offset + length]
+        if zlib.crc32(data) != crc:
+            raise CorruptedFile(f"{self.name} is damaged: wrong directory checksum")
+        return loads(zlib.decompress(data))
+
+    def block(self, position: tuple) -> bytes:
+        offset, length, crc, size = position
+        block = self.mmap[offset: offset + length]
+        if zlib.crc32(block) != crc:
+            raise CorruptedFile(f"{self.name} is damaged: wrong checksum of a record at {offset}")
+        METRICS.count("journal.bytes_read", length)
+        return block
+
+    def read(self, position: tuple):
+        """(key, value) of the record stored at position"""
+        block = self.block(position)
+        if self.codec == ZLIB:
+            try:
+                block = zlib.decompressobj(WBITS, zdict=self.zdict).decompress(block)
+            except zlib.error:
+                raise CorruptedFile(f"{self.name} is damaged: a record at {position[0]} can't be unpacked")
+        return self.load_entry(block)
+
+    def close(self) -> None:
+        self.mmap.close()
+
+
+class Records(MutableMapping):
+    """
+    Records of a snapshot decoded on first access, plus the ones changed
+    since. Changed records are kept until a snapshot has them, decoded
+    ones only while they are among the CACHE_SIZE used last.
+    """
+    CACHE_SIZE = 1000
+
+    def __init__(self, snapshot: Snapshot = None, loaded: dict = None):
+        self.snapshot = snapshot
+        self.positions = snapshot.positions if snapshot is not None else {}  # keys of the snapshot
+        self.added = dict.fromkeys(loaded) if loaded else {}  # keys missing in the snapshot
+        self.loaded = loaded if loaded is not None else {}  # records the snapshot doesn't have
+        self.cache = OrderedDict()  # records decoded from the snapshot, used last at the end
+        self.on_load = None  # called with every decoded record
+
+    def __len__(self) -> int:
+        return len(self.positions) + len(self.added)
+
+    def __iter__(self):
+        yield from self.positions
+        yield from self.added
+
+    def __contains__(self, key) -> bool:
+        return key in self.positions or key in self.added
+
+    def __getitem__(self, key):
+        try:
+            return self.loaded[key]
+        except KeyError:
+            pass
+        try:
+            value = self.cache[key]
+        except KeyError:
+            pass
+        else:
+            self.cache.move_to_end(key)
+            return value
+        position = self.positions[key]
+        stored_key, value = self.snapshot.read(position)
+        if self.on_load is not None:
+            self.on_load(value)
+        self.cache[key] = value
+        if len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return value
+
+    def __setitem__(self, key, value) -> None:
+        if key not in self.positions:
+            self.added[key] = None
+        self.loaded[key] = value
+        self.cache.pop(key, None)
+
+    def __delitem__(self, key) -> None:
+        if self.positions.pop(key, None) is None:
+            del self.added[key]
+        self.loaded.pop(key, None)
+        self.cache.pop(key, None)
+
+    def replace_snapshot(self, snapshot: Snapshot) -> None:
+        """Records are read from snapshot from now on, it has all of them"""
+        self.snapshot = snapshot
+        self.positions = snapshot.positions
+        self.added = {}
+        self.cache.update(self.loaded)
+        self.loaded = {}
+        while len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def metas(self, dump_meta):
+        """
+        (key, index data) of every record, read from the directory
+        for records not decoded, so indexes are built without decoding
+        """
+        metas = self.snapshot.metas if self.snapshot is not None else None
+        for key in self:
+            meta = None
+            if key not in self.loaded and metas:
+                meta = metas.get(key)
+            yield key, meta if meta is not None else dump_meta(self[key])
+        if self.snapshot is not None:
+            self.snapshot.metas = None
+
+
+class Journal:
+    """
+    Snapshot of all records plus append-only log of changes next to it.
+    Every entry is a (key, value) pair, value None means the key was deleted.
+    dump_meta gives what indexes need of a value, it is kept in the snapshot
+    directory so the records themselves are decoded only when used.
+    Several processes may share the files: writes are made under a lock
+    file, and the version read - snapshot stamp and log length - tells
+    when another process has committed.
+    """
+    MAGIC = b"SBJ1"  # snapshots of version 1, a sequence of frames
+    COMPACT_MIN_SIZE = 1024 * 1024  # log bytes before compaction is considered
+
+    def __init__(self, file_name: str, dump_entry=dump_entry, load_entry=load_entry,
+                 legacy_load=legacy_load, dump_meta=None):
+        self.file_name = file_name
+        self.log_name = file_name + ".log"
+        self.dump_entry = dump_entry
+        self.load_entry = load_entry
+        self.legacy_load = legacy_load
+        self.dump_meta = dump_meta
+        self.snapshot_size = 0  # bytes of the records in the snapshot, as they are in the log
+        self.log_size = 0
+        self.log_keys = set()  # keys changed since the snapshot
+        self.version = None  # (snapshot stamp, log size) of what was read
+        self._log = None
+        self._batch_depth = 0
+        self._unsynced = False
+        self._lock_fd = None
+        self._locked = False
+        self._log_stat = None  # size and mtime of the log when last checked
+        self._torn_at = None  # where the log ends with a partly written entry
+
+    def load(self) -> Records:
+        """
+        Reads the snapshot directory and replays the log over it.
+        Raises CorruptedFile instead of losing records of a damaged file
+        """
+        with self._reading():
+            data, legacy = self._read()
+        if self._locked:
+            self._drop_torn_tail()
+
+        if legacy:
+            with self.batch():
+                self.lock()
+                self.snapshot(data)
+
+        return data
+
+    def _read(self) -> (Records, bool):
+        # the files as they are, under a lock so a compaction isn't seen half done
+        data = Records()
+        legacy = False
+        stamp = None
+        if os.path.exists(self.file_name):
+            with open(self.file_name, "rb") as f:
+                # the stamp of the file really read, it may be replaced meanwhile
+                stamp = self._stamp(os.fstat(f.fileno()))
+                magic = f.read(len(self.MAGIC))
+                if magic == Snapshot.MAGIC:
+                    snapshot = Snapshot(f, self.load_entry)
+                    data = Records(snapshot)
+                    self.snapshot_size = snapshot.data_size
+                    METRICS.count("journal.bytes_read", snapshot.directory_size)
+                else:
+                    # older formats are read whole and written again in the current one
+                    legacy = True
+                    if magic == self.MAGIC:
+                        for key, value in self._read_frames(f):
+                            data[key] = value
+                    else:
+                        f.seek(0)
+                        try:
+                            data = Records(loaded=self.legacy_load(f))
+                        except Exception as error:
+                            raise CorruptedFile(f"{self.file_name} is damaged: {error}")
+                    METRICS.count("journal.bytes_read", stamp[0])
+                    self.snapshot_size = stamp[0]
+
+        self.log_size = 0
+        self.log_keys = set()
+        if os.path.exists(self.log_name):
+            with open(self.log_name, "rb") as f:
+                magic = f.read(len(LOG_MAGIC))
+                if magic == LOG_MAGIC:
+                    entries = self._read_entries(f)
+                elif LOG_MAGIC.startswith(magic):
+                    # empty, or the first write was interrupted
+                    f.seek(0)
+                    self._torn_at = 0 if magic else None
+                    entries = ()
+                else:
+                    # logs written before entries had checksums
+                    f.seek(0)
+                    entries = self._read_frames(f)
+                    legacy = True
+                for key, value in entries:
+                    self.log_keys.add(key)
+                    if value is None:
+                        if key in data:
+                            del data[key]
+                    else:
+                        data[key] = value
+                self.log_size = f.tell()
+                METRICS.count("journal.bytes_read", self.log_size)
+        self.version = stamp, self.log_size
+        return data, legacy
+
+    def changes(self) -> dict:
+        """
+        Entries committed by other processes since the last read.
+        None if the snapshot was replaced and everything must be loaded again.
+        Costs one stat call when nothing has changed.
+        """
+        if self._locked:
+            # nobody else commits meanwhile, our own writes may be still buffered
+            return {}
+        if self._log_file_stat() == self._log_stat:
+            # every commit, compaction too, writes the log
+            return {}
+        with self._reading():
+            return self._changes()
+
+    def _changes(self) -> dict:
+        # under a lock, the log read belongs to the snapshot checked
+        log_stat = self._log_file_stat()
+        if self.snapshot_stamp() != self.version[0]:
+            return None
+        self._log_stat = log_stat
+        size = log_stat[0]
+        if size == self.log_size:
+            return {}
+        if size < self.log_size:
+            return None
+
+        changes = {}
+        with open(self.log_name, "rb") as f:
+            if self.log_size == 0:
+                if f.read(len(LOG_MAGIC)) != LOG_MAGIC:
+                    # load() knows the other formats
+                    return None
+            else:
+                f.seek(self.log_size)
+            for key, value in self._read_entries(f):
+                changes[key] = value
+                self.log_keys.add(key)
+            METRICS.count("journal.bytes_read", f.tell() - self.log_size)
+            self.log_size = f.tell()
+        self.version = self.version[0], self.log_size
+        return changes
+
+    def lock(self) -> dict:
+        """
+        Takes the write lock until the end of the batch or of the next append.
+        Returns changes of other processes the caller must merge, like changes()
+        """
+        if self._locked:
+            return {}
+        lock_file(self._lock_file())
+        self._locked = True
+        try:
+            changes = self._changes()
+        except BaseException:
+            self.unlock()
+            raise
+        if changes is not None:
+            self._drop_torn_tail()
+        return changes
+
+    def _lock_file(self) -> int:
+        if self._lock_fd is None:
+            self._lock_fd = os.open(self.file_name + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        return self._lock_fd
+
+    @contextmanager
+    def _reading(self):
+        """
+        Shared lock for reading the files: readers don't wait for each other,
+        but nobody commits or compacts meanwhile
+        """
+        if self._locked:
+            yield
+            return
+        try:
+            fd = self._lock_file()
+        except OSError:
+            # a read-only place, nobody writes there either
+            yield
+            return
+        lock_file(fd, shared=True)
+        try:
+            yield
+        finally:
+            unlock_file(fd)
+
+    def _log_file_stat(self) -> tuple:
+        try:
+            stat = os.stat(self.log_name)
+            return stat.st_size, stat.st_mtime_ns
+        except OSError:
+            return 0, None
+
+    def _drop_torn_tail(self) -> None:
+        # nobody writes without the lock: a partly written last entry is left by an interrupted write
+        if self._torn_at is None or self._torn_at != self.log_size:
+            return
+        try:
+            with open(self.log_name, "r+b") as f:
+                f.truncate(self._torn_at)
+        except OSError:
+            pass
+        self._torn_at = None
+
+    def unlock(self) -> None:
+        if self._locked:
+            # others read what was written before the lock is theirs, the fsync may wait
+            if self._log is not None:
+                self._log.flush()
+            self._locked = False
+            unlock_file(self._lock_fd)
+
+    @contextmanager
+    def locked(self):
+        """
+        Holds the write lock for one group of changes only, not for the
+        whole batch, so other processes wait no longer than it takes.
+        Gives changes of others to merge, like lock()
+        """
+        taken = not self._locked
+        changes = self.lock()
+        try:
+            yield changes
+        finally:
+            if taken:
+                self.unlock()
+
+    def _read_entries(self, f):
+        """
+        Entries of the log, a damaged one raises CorruptedFile.
+        Only the file ending inside an entry with a sound header
+        (or inside the header) counts as an interrupted write
+        """
+        self._torn_at = None
+        while True:
+            pos = f.tell()
+            header = f.read(LOG_FRAME.size)
+            if len(header) < LOG_FRAME.size:
+                f.seek(pos)
+                self._torn_at = pos if header else None
+                return
+            size, crc, header_crc = LOG_FRAME.unpack(header)
+            if zlib.crc32(header[:-4]) != header_crc:
+                raise CorruptedFile(f"{f.name} is damaged: wrong checksum of an entry header at {pos}")
+            payload = f.read(size)
+            if len(payload) < size:
+                f.seek(pos)
+                self._torn_at = pos
+                return
+            if zlib.crc32(payload) != crc:
+                raise CorruptedFile(f"{f.name} is damaged: wrong checksum of an entry at {pos}")
+            yield self._load(payload, f.name, pos)
+
+    def _read_frames(self, f):
+        """
+        Entries of version 1 snapshots and old logs. They have no checksums,
+        so an incomplete entry can't be told from a damaged length and raises
+        """
+        while True:
+            pos = f.tell()
+            header = f.read(FRAME.size)
+            if not header:
+                return
+            size, = FRAME.unpack(header) if len(header) == FRAME.size else (None,)
+            payload = f.read(size) if size is not None else b""
+            if size is None or len(payload) < size:
+                raise CorruptedFile(f"{f.name} is damaged: an entry at {pos} is incomplete")
+            yield self._load(payload, f.name, pos)
+
+    def _load(self, payload: bytes, name: str, pos: int):
+        try:
+            return self.load_entry(payload)
+        except Exception as error:
+            raise CorruptedFile(f"{name} is damaged: an entry at {pos} can't be read ({error})")
+
+    def _frame(self, key, value) -> bytes:
+        payload = self.dump_entry(key, value)
+        header = LOG_FRAME.pack(len(payload), zlib.crc32(payload), 0)[:-4]
+        return header + FRAME.pack(zlib.crc32(header)) + payload
+
+    def append(self, key, value) -> None:
+        """
+        Appends one change to the log, value None marks deletion.
+        Changes of others must be merged first, see lock()
+        """
+        if not self._locked:
+            self.lock()
+        if self._log is None:
+            self._log = open(self.log_name, "ab")
+        frame = self._frame(key, value)
+        if self.log_size == 0:
+            # a new log starts with its format
+            frame = LOG_MAGIC + frame
+        self._log.write(frame)
+        self.log_keys.add(key)
+        self.log_size += len(frame)
+        self.version = self.version[0], self.log_size
+        METRICS.count("journal.bytes_written", len(frame))
+        self._unsynced = True
+        if not self._batch_depth:
+            self.sync()
+            self.unlock()
+
+    def sync(self) -> None:
+        if self._log is not None and self._unsynced:
+            self._log.flush()
+            os.fsync(self._log.fileno())
+        self._unsynced = False
+
+    @contextmanager
+    def batch(self):
+        """Group commit: changes made inside share one flush at the end"""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                try:
+                    self.sync()
+                finally:
+                    self.unlock()
+
+    def should_compact(self) -> bool:
+        return self.log_size > max(self.COMPACT_MIN_SIZE, self.snapshot_size)
+
+    def snapshot(self, data, changed=()) -> None:
+        """
+        Atomically replaces the snapshot with records of data and clears the log.
+        Must be called under the lock with changes of others merged,
+        changed are keys of records changed and not appended yet
+        """
+        old = data.snapshot if isinstance(data, Records) else None
+        if old is not None and old.codec == ZLIB and old.count >= ZDICT_SAMPLE:
+            # blocks of records not changed since the old snapshot are copied as they are
+            zdict = old.zdict
+            copied = {key: position for key, position in data.positions.items()
+                      if key not in self.log_keys and key not in changed}
+            metas = {entry[0]: entry[5] for entry in old.read_directory()[1] if entry[0] in copied}
+        else:
+            zdict = self._make_zdict(data)
+            copied = {}
+        compressor = zlib.compressobj(6, zlib.DEFLATED, WBITS, MEM_LEVEL, zdict=zdict)
+
+        tmp_name = self.file_name + ".tmp"
+        entries = []
+        data_size = 0
+        with open(tmp_name, "wb") as f:
+            offset = HEADER.size + HEADER_CRC.size
+            f.write(bytes(offset))
+            for key in list(data):
+                if key in copied:
+                    position = copied[key]
+                    block = old.block(position)
+                    crc, size = position[2:]
+                    meta = metas[key]
+                else:
+                    value = data[key]
+                    payload = self.dump_entry(key, value)
+                    block = compressor.copy()
+                    block = block.compress(payload) + block.flush()
+                    crc, size = zlib.crc32(block), len(payload)
+                    meta = self.dump_meta(value) if self.dump_meta is not None else None
+                f.write(block)
+                entries.append((key, offset, len(block), crc, size, meta))
+                offset += len(block)
+                data_size += size
+            directory = zlib.compress(dumps((zdict, entries), HIGHEST_PROTOCOL), 1)
+            f.write(directory)
+            header = HEADER.pack(Snapshot.MAGIC, SNAPSHOT_VERSION, ZLIB, len(entries),
+                                 offset, len(directory), zlib.crc32(directory))
+            f.seek(0)
+            f.write(header + HEADER_CRC.pack(zlib.crc32(header)))
+            f.flush()
+            os.fsync(f.fileno())
+        METRICS.count("journal.bytes_written", offset + len(directory))
+        self.snapshot_size = data_size
+        os.replace(tmp_name, self.file_name)
+        self._sync_dir()
+
+        if isinstance(data, Records):
+            # records not decoded are read from the new file from now on
+            with open(self.file_name, "rb") as f:
+                snapshot = Snapshot(f, self.load_entry)
+            snapshot.metas = None
+            data.replace_snapshot(snapshot)
+            if old is not None:
+                old.close()
+
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        with open(self.log_name, "wb") as f:
+            f.write(LOG_MAGIC)
+        self.log_size = len(LOG_MAGIC)
+        self.log_keys = set()
+        self.version = self.snapshot_stamp(), self.log_size
+        self._unsynced = False
+
+    def _make_zdict(self, data) -> bytes:
+        sample = []
+        for key in list(data)[:ZDICT_SAMPLE]:
+            sample.append(self.dump_entry(key, data[key]))
+        return b"".join(sample)[-ZDICT_SIZE:]
+
+    def snapshot_stamp(self):
+        """Identifies the current snapshot file, None if there is none"""
+        try:
+            return self._stamp(os.stat(self.file_name))
+        except OSError:
+            return None
+
+    @staticmethod
+    def _stamp(stat: os.stat_result) -> tuple:
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def _sync_dir(self) -> None:
+        try:
+            fd = os.open(os.path.dirname(os.path.abspath(self.file_name)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def close(self) -> None:
+        self.sync()
+        self.unlock()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+
+class Sequence:
+    """
+    Monotonic counter kept in a small file, shared by every process using it
+    """
+    def __init__(self, file_name: str = None):
+        self.file_name = file_name
+        self.last = 0
+        self._lock = Lock()
+
+    def next(self, floor: int = 0) -> int:
+        """Next value, always greater than floor and than any value given before"""
+        with self._lock:
+            if self.file_name is None:
+                self.last = max(self.last, floor) + 1
+                return self.last
+
+            fd = os.open(self.file_name, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                lock_file(fd)
+                try:
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    stored = os.read(fd, 32).strip()
+                    last = max(int(stored or 0), self.last, floor) + 1
+                    value = str(last).encode()
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    os.write(fd, value)
+                    os.ftruncate(fd, len(value))
+                finally:
+                    unlock_file(fd)
+            finally:
+                os.close(fd)
+            self.last = last
+            return last
+
+
+def merge_change(base: tuple, ours, theirs, fields, merge):
+    """
+    Three-way merge of a value changed here and in another process, None
+    stands for a deleted one. base is fields() of the value before the change
+    here, None if it was added here. Raises ValueError if merge() can't
+    reconcile the two, or one side deleted what the other changed
+    """
+    if ours is None or theirs is None:
+        if base is None or ours is theirs:
+            # added here only, or deleted on both sides
+            return ours
+        # a deletion stands if the other side left the value as it was
+        if fields(theirs if ours is None else ours) == base:
+            return None
+        raise ValueError("Deleted on one side and changed on the other")
+    return merge(base, ours, theirs)
+
+
+def check_conflicts(kind: str, keys: [str]) -> None:
+    if keys:
+        raise ValueError(f"{kind} {', '.join(keys)} changed by another process meanwhile, "
+                         "your changes to them were not saved")
+
+
+class JournalBook(ABC):
+    """
+    Book of values kept in a Journal under their keys. Values changed here
+    are saved one entry each, changes other processes saved meanwhile are
+    merged in. A value tells its book before it changes, see keep_base(),
+    so both changes of one value are merged field by field.
+    """
+    KIND = "Records"  # how conflict messages call the values
+    journal = None
+
+    @abstractmethod
+    def fields(self, value) -> tuple:
+        """What merge_fields() compares, taken before the value changes"""
+
+    @abstractmethod
+    def merge_fields(self, base: tuple, ours, theirs):
+        """Value with changes of both sides, ValueError if they can't be merged"""
+
+    @abstractmethod
+    def index(self, value) -> None:
+        """Adds the value to indexes"""
+
+    @abstractmethod
+    def unindex(self, key) -> None:
+        """Removes the value of key from indexes"""
+
+    @abstractmethod
+    def rebuild(self, records: Records) -> None:
+        """Takes restored records as data and builds indexes of them"""
+
+    def mark_dirty(self, key) -> None:
+        self._dirty.add(key)
+
+    def value_changed(self, key, value) -> None:
+        # data may drop a decoded value, so the changed one is put back in it
+        self.data[key] = value
+        self.index(value)
+        self.mark_dirty(key)
+
+    def keep_base(self, key, value) -> None:
+        # the first change since the last save keeps what was stored
+        self._base.setdefault(key, self.fields(value))
+
+    def attach(self, value) -> None:
+        value.book = self
+
+    def batch(self):
+        """All changes inside share one flush to disk"""
+        if self.journal is None:
+            return nullcontext()
+        return self.journal.batch()
+
+    @timed()
+    def save(self):
+        # only values changed since the last save go to the journal
+        if self.journal is None or not self._dirty:
+            return
+        with self.journal.batch(), self.journal.locked() as changes:
+            # other processes' changes come first, ours are merged into them
+            conflicts = self.merge(changes)
+            for key in self._dirty:
+                self.journal.append(key, self.data.get(key))
+            self._dirty.clear()
+            self._base.clear()
+            if self.journal.should_compact():
+                self.compact()
+        check_conflicts(self.KIND, conflicts)
+
+    @timed()
+    def compact(self):
+        with self.journal.batch(), self.journal.locked() as changes:
+            conflicts = self.merge(changes)
+            self.journal.snapshot(self.data, self._dirty)
+            self.compacted()
+        check_conflicts(self.KIND, conflicts)
+
+    def compacted(self) -> None:
+        """Called under the lock once the snapshot is written"""
+
+    def refresh(self) -> None:
+        """Takes changes other processes have saved, files are read only if they changed"""
+        if self.journal is not None:
+            check_conflicts(self.KIND, self.merge(self.journal.changes()))
+
+    def merge(self, changes: dict) -> list:
+        """
+        Applies values changed elsewhere. Values changed here too are merged
+        field by field; keys of the ones that can't be merged are returned,
+        the changes made here are dropped for them
+        """
+        bases = self._base
+        if changes is None:
+            # the journal was compacted by another process, read it again
+            pending = {key: self.data.get(key) for key in self._dirty}
+            self.restore()
+            changes = {key: self.data.get(key) for key in pending}
+        else:
+            pending = {key: self.data.get(key) for key in self._dirty if key in changes}
+            for key, value in changes.items():
+                if key not in pending:
+                    bases.pop(key, None)
+                    self.apply(key, value)
+        conflicts = []
+        for key, value in pending.items():
+            theirs = changes[key]
+            their_fields = self.fields(theirs) if theirs is not None else None
+            try:
+                value = merge_change(bases.get(key), value, theirs, self.fields, self.merge_fields)
+            except ValueError:
+                conflicts.append(key)
+                value = theirs
+                self._dirty.discard(key)
+                self._base.pop(key, None)
+            else:
+                self._dirty.add(key)
+                # what is stored now is what further changes are merged with
+                self._base[key] = their_fields
+            self.apply(key, value)
+        return conflicts
+
+    def apply(self, key, value) -> None:
+        """Puts a value read from the journal in place, None removes it"""
+        old = self.data.get(key)
+        if old is not None:
+            old.book = None
+            self.unindex(key)
+        if value is None:
+            if old is not None:
+                self.data.pop(key)
+                self.keys_index.remove(key)
+            return
+        self.data[key] = value
+        if old is None:
+            self.keys_index.add(key)
+        value.book = self
+        self.index(value)
+
+    @timed()
+    def restore(self):
+        self._dirty = set()  # keys changed here and not saved yet
+        self._base = {}  # key -> fields() of a dirty value before it changed here
+        # a damaged file raises CorruptedFile and is left as it is
+        records = self.journal.load() if self.journal is not None else Records()
+        records.on_load = self.attach
+        # the ones replayed from the log are decoded already
+        for value in records.loaded.values():
+            self.attach(value)
+        self.rebuild(records)
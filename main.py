@@ -1,33 +1,73 @@
-from handler import CommandCreator, Command
-from interfaces import ConsoleUserInterface
+from time import perf_counter
+STARTED = perf_counter()
+
+import atexit
+import sys
+from argparse import ArgumentParser
+from handler import CommandCreator
+from interfaces import ConsoleUserInterface, Session
+from batch import BatchRunner
+from handler import config
+from metrics import METRICS
+
+IMPORTED = perf_counter()
      
 
 def main():
     ui = ConsoleUserInterface()
-    handler = CommandCreator()
+    session = Session(ui.Menu, CommandCreator())
     ui.data_output(ui.Menu.navigate("Main"))
-    command: Command = None
 
     while not ui.Menu.close:
-        output_data = ""
         user_data = ui.data_input()
+        ui.data_output(session.respond(user_data))
+
+
+def startup_report() -> str:
+    return f"Imports: {(IMPORTED - STARTED) * 1000:.1f} ms, " \
+           f"ready in {(perf_counter() - STARTED) * 1000:.1f} ms\n" \
+           + CommandCreator.targets.report()
+
+
+def run_batch(script: str, flush_every: int = 0) -> int:
+    """Runs commands from script file, '-' reads them from stdin"""
+    runner = BatchRunner(sys.stdout, flush_every)
+    if script == "-":
+        return runner.run(sys.stdin)
+    with open(script, "r", encoding="utf-8") as f:
+        return runner.run(f)
+
 
-        if command is None:
-            output_data = ui.Menu.navigate(user_data)
-            command = handler.create(user_data)
-        else:
-            command.set_args(user_data)
-        
-        if not command is None:
-            result = command.execute()
-            if command.success:
-                command = None
-        if not output_data:
-            output_data = result
-
-        ui.data_output(output_data)
-
-        
 if __name__ == "__main__":
-    
-    main()
\ No newline at end of file
+    parser = ArgumentParser(description="Personal assistant bot")
+    parser.add_argument("--batch", metavar="SCRIPT",
+                        help="run commands from SCRIPT ('-' for stdin) and print JSON lines")
+    parser.add_argument("--flush-every", type=int, default=0, metavar="N",
+                        help="in batch mode save changes every N commands instead of once at the end")
+    parser.add_argument("--serve", metavar="[HOST:]PORT",
+                        help="serve many users over TCP, one command or argument per line")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="load address book and notebook in background right after start")
+    parser.add_argument("--startup-report", action="store_true",
+                        help="print import and loading times to stderr at start and exit")
+    parser.add_argument("--stats", action="store_true",
+                        help="collect command latencies and I/O for the stats command")
+    options = parser.parse_args()
+
+    if options.stats:
+        METRICS.enabled = True
+    if options.prefetch or options.serve or config.get("prefetch", "N").lower() == "y":
+        CommandCreator.targets.prefetch()
+    if options.startup_report:
+        print(startup_report(), file=sys.stderr)
+        atexit.register(lambda: print(startup_report(), file=sys.stderr))
+
+    if options.serve:
+        # asyncio takes longer to import than the rest of the bot
+        from server import run_server
+        host, _, port = options.serve.rpartition(":")
+        run_server(host or "127.0.0.1", int(port))
+    elif options.batch:
+        sys.exit(1 if run_batch(options.batch, options.flush_every) else 0)
+    else:
+        main()
@@ -1,9 +1,9 @@
 class Menu():
     close = False
     MENU = {
-    "Main": ["Hello", "Contacts", "Notes", "File Sorter", "Exit/Close/Good Bye"],
-    "Contacts": ["Add", "Delete", "Add phone", "Del phone", "Find", "DTB", "SBS", "Show", "Next"],
-    "Notes": ["Add", "Delete", "Add tag", "Del tag", "Find", "Show", "Next"],
+    "Main": ["Hello", "Contacts", "Notes", "File Sorter", "Find duplicates", "Stats", "Save stats", "Exit/Close/Good Bye"],
+    "Contacts": ["Add", "Delete", "Add phone", "Del phone", "Find", "Fuzzy", "DTB", "SBS", "Show", "Next", "Import", "Export"],
+    "Notes": ["Add", "Delete", "Add tag", "Del tag", "Find", "Search", "Top tags", "Show", "Next", "Import", "Export"],
     "Edit": [],
     "Add": [],
     "Delete": [],
@@ -0,0 +1,185 @@
+#########################
+#------Instrumentation--#
+#########################
+import json
+import os
+from functools import wraps
+from time import perf_counter_ns
+
+
+def bucket_of(value: int) -> int:
+    # exact below 8, then four buckets per power of two
+    if value < 8:
+        return value
+    shift = value.bit_length() - 3
+    return (shift << 2) + (value >> shift)
+
+
+def bucket_bound(bucket: int) -> int:
+    """The largest value of the bucket"""
+    if bucket < 8:
+        return bucket
+    shift = (bucket >> 2) - 1
+    return (((bucket & 3 | 4) + 1) << shift) - 1
+
+
+class Histogram:
+    """
+    Distribution of non-negative integer values, nanoseconds or counts,
+    kept in buckets at most a quarter wide
+    """
+    def __init__(self):
+        self.buckets = {}  # bucket -> number of values
+        self.count = 0
+        self.total = 0
+
+    def observe(self, value: int) -> None:
+        bucket = bucket_of(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, share: float) -> int:
+        """Upper bound of the bucket holding the value at the share"""
+        if not self.count:
+            return 0
+        rank = share * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return bucket_bound(bucket)
+        return bucket_bound(max(self.buckets))
+
+    def cumulative(self):
+        """(upper bound, values below it) pairs for exporting"""
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            yield bucket_bound(bucket), seen
+
+    def to_dict(self) -> dict:
+        return {
+                "count": self.count,
+                "sum": self.total,
+                "p50": self.percentile(0.5),
+                "p95": self.percentile(0.95),
+                "p99": self.percentile(0.99),
+                "buckets": {bound: seen for bound, seen in self.cumulative()},
+                }
+
+
+class Metrics:
+    """
+    Latencies (ns), sizes and counters of the running bot.
+    Nothing is recorded while disabled.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.latencies = {}  # operation -> Histogram of nanoseconds
+        self.values = {}  # "operation.what" -> Histogram of counts, e.g. records scanned
+        self.counters = {}  # name -> total, e.g. bytes written
+
+    def time(self, name: str, nanoseconds: int) -> None:
+        histogram = self.latencies.get(name)
+        if histogram is None:
+            histogram = self.latencies[name] = Histogram()
+        histogram.observe(nanoseconds)
+
+    def observe(self, name: str, value: int) -> None:
+        if not self.enabled:
+            return
+        histogram = self.values.get(name)
+        if histogram is None:
+            histogram = self.values[name] = Histogram()
+        histogram.observe(value)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def reset(self) -> None:
+        self.latencies.clear()
+        self.values.clear()
+        self.counters.clear()
+
+    def report(self) -> str:
+        lines = []
+        for name in sorted(self.latencies):
+            histogram = self.latencies[name]
+            lines.append(f"{name}: {histogram.count} calls, "
+                         f"p50 {format_ns(histogram.percentile(0.5))}, "
+                         f"p95 {format_ns(histogram.percentile(0.95))}, "
+                         f"p99 {format_ns(histogram.percentile(0.99))}")
+        for name in sorted(self.values):
+            histogram = self.values[name]
+            lines.append(f"{name}: p50 {histogram.percentile(0.5)}, p95 {histogram.percentile(0.95)}, "
+                         f"p99 {histogram.percentile(0.99)}, {histogram.total} in total")
+        for name in sorted(self.counters):
+            lines.append(f"{name}: {self.counters[name]}")
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        return {
+                "latency_ns": {name: h.to_dict() for name, h in self.latencies.items()},
+                "values": {name: h.to_dict() for name, h in self.values.items()},
+                "counters": dict(self.counters),
+                }
+
+    def to_prometheus(self) -> str:
+        lines = ["# TYPE simple_bot_latency_seconds histogram"]
+        for name, histogram in sorted(self.latencies.items()):
+            for bound, seen in histogram.cumulative():
+                lines.append(f'simple_bot_latency_seconds_bucket{{operation="{name}",le="{bound / 1e9:g}"}} {seen}')
+            lines.append(f'simple_bot_latency_seconds_bucket{{operation="{name}",le="+Inf"}} {histogram.count}')
+            lines.append(f'simple_bot_latency_seconds_sum{{operation="{name}"}} {histogram.total / 1e9:g}')
+            lines.append(f'simple_bot_latency_seconds_count{{operation="{name}"}} {histogram.count}')
+        lines.append("# TYPE simple_bot_values histogram")
+        for name, histogram in sorted(self.values.items()):
+            for bound, seen in histogram.cumulative():
+                lines.append(f'simple_bot_values_bucket{{name="{name}",le="{bound}"}} {seen}')
+            lines.append(f'simple_bot_values_bucket{{name="{name}",le="+Inf"}} {histogram.count}')
+            lines.append(f'simple_bot_values_sum{{name="{name}"}} {histogram.total}')
+            lines.append(f'simple_bot_values_count{{name="{name}"}} {histogram.count}')
+        lines.append("# TYPE simple_bot_total counter")
+        for name, total in sorted(self.counters.items()):
+            lines.append(f'simple_bot_total{{name="{name}"}} {total}')
+        return "\n".join(lines) + "\n"
+
+    def save(self, file_name: str) -> None:
+        """Writes JSON for .json files and Prometheus text format otherwise"""
+        if os.path.splitext(file_name)[1].lower() == ".json":
+            data = json.dumps(self.to_dict(), indent=2)
+        else:
+            data = self.to_prometheus()
+        with open(file_name, "w", encoding="utf-8") as f:
+            f.write(data)
+
+
+def format_ns(nanoseconds: int) -> str:
+    if nanoseconds < 1000:
+        return f"{nanoseconds} ns"
+    if nanoseconds < 1000000:
+        return f"{nanoseconds / 1000:.1f} us"
+    return f"{nanoseconds / 1000000:.1f} ms"
+
+
+METRICS = Metrics()
+
+
+def timed(name: str = None):
+    """Records latency of every call while METRICS is enabled"""
+    def decorator(func):
+        label = name or func.__qualname__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return func(*args, **kwargs)
+            start = perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                METRICS.time(label, perf_counter_ns() - start)
+        return wrapper
+    return decorator
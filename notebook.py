@@ -1,11 +1,18 @@
 from datetime import datetime
 from collections import UserDict
+from json import dumps, loads
+import os
 from pickle import dump, load
 from address_book import Pagination, Target
+from journal import Journal, JournalBook, Sequence, Records
+from metrics import METRICS, timed
+from indexes import InvertedIndex, TagStats, TextIndex, SortedKeys, normalize_tag
 
 DATETIME_FORMAT = "%H:%M:%S %d.%m.%Y"
 
 class Note:
+    book = None  # NoteBook the note belongs to
+
     def __init__(self, text: str, tags: [str]) -> None:
         self.created = datetime.now()
         self.id = None
@@ -14,7 +21,43 @@ class Note:
         self.tags = tags
 
     def edit_text(self, new_text: str) -> None:
+        self.changing()
         self.text = new_text
+        self.changed()
+
+    def changing(self) -> None:
+        # called before a change, so the book knows what the note was
+        if self.book is not None:
+            self.book.note_changing(self)
+
+    def changed(self) -> None:
+        if self.book is not None:
+            self.book.note_changed(self)
+
+    def to_dict(self) -> dict:
+        return {
+                "id": self.id,
+                "created": self.created.isoformat(),
+                "text": self.text,
+                "tags": sorted(self.tags),
+                }
+
+    @classmethod
+    def from_dict(cls, item: dict):
+        note = cls(item["text"], item["tags"])
+        note.id = item["id"]
+        note.created = datetime.fromisoformat(item["created"])
+        return note
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("book", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # notes pickled before tag keys get them here
+        self.tags = state.get("_tags", ())
 
     @property
     def tags(self) -> [str]:
@@ -23,20 +66,29 @@ class Note:
     @tags.setter
     def tags(self, new_tags: [str]) -> None:
         self._tags = set()
+        self.tag_keys = set()  # normalized tags used for search
         for tag in new_tags:
+            key = normalize_tag(tag)
+            if not key or key in self.tag_keys:
+                continue
             if not tag.startswith("#"):
                 tag = "#" + tag
+            self.tag_keys.add(key)
             self._tags.add(tag)
 
     def add_tags(self, tags: [str]) -> None:
-        cur_tags = self.tags
-        self.tags = tags
-        self.tags.update(cur_tags)
+        # tags the note already has keep their spelling
+        self.changing()
+        self.tags = list(self.tags) + list(tags)
+        self.changed()
 
     def remove_tag(self, tag: str) -> None:
-        if tag not in self.tags:
+        key = normalize_tag(tag)
+        if key not in self.tag_keys:
             raise ValueError("There is no such tag!")
-        self.tags.remove(tag)
+        self.changing()
+        self.tags = [tag for tag in self.tags if normalize_tag(tag) != key]
+        self.changed()
 
     def __str__(self) -> str:
         return f'id: {self.id}\n' \
@@ -44,9 +96,60 @@ class Note:
                 f'{self.text}\n' \
                 f'tags: {" ".join(self.tags)}'
 
-class NoteBook(Target, UserDict):
+def dump_note(id: str, note: Note) -> bytes:
+    item = note.to_dict() if note is not None else {"id": id}
+    return dumps(item, ensure_ascii=False).encode()
+
+
+def load_note(payload: bytes):
+    item = loads(payload)
+    note = Note.from_dict(item) if "text" in item else None
+    return item["id"], note
+
+
+def note_meta(note: Note) -> tuple:
+    # tag keys are all the indexes need without decoding the note
+    return tuple(note.tag_keys)
+
+
+def note_fields(note: Note) -> tuple:
+    # what notes are merged by
+    return note.text, frozenset(note.tags)
+
+
+def merge_note(base: tuple, ours: Note, theirs: Note) -> Note:
+    """
+    Three-way merge of a note changed here and in another process, base is
+    note_fields() of it before the change here. The text is taken from
+    the side that changed it, tags are merged one by one
+    """
+    base_text, base_tags = base or (None, frozenset())
+    if ours.text != base_text and theirs.text not in (base_text, ours.text):
+        raise ValueError("Changed on both sides")
+    if ours.text != base_text:
+        theirs.text = ours.text
+    removed = base_tags - ours.tags
+    theirs.tags = [tag for tag in theirs.tags if tag not in removed] + \
+        [tag for tag in ours.tags if tag not in base_tags]
+    return theirs
+
+
+def legacy_load(f) -> dict:
+    # notebooks written before the journal are a pickle of the whole NoteBook
+    return load(f).data
+
+
+class NoteBook(JournalBook, Target, UserDict):
+    KIND = "Notes"
+
     def __init__(self, file_name: str=None) -> None:
-        self.tag_cloud = set()  #all unique tags used in notebook
+        self.tag_stats = TagStats()  # how many notes use each tag
+        self.journal = None
+        self.tag_index = InvertedIndex()  # tag -> ids of notes
+        self.text_index = TextIndex()
+        self.keys_index = SortedKeys(sort_key=int)
+        self.id_sequence = Sequence()
+        self.last_id = 0  # greatest id ever seen in the notebook
         self.__file_name = None
         self.file_name = file_name
 
@@ -57,6 +160,12 @@ class NoteBook(Target, UserDict):
     @file_name.setter
     def file_name(self, file_name:str):
         self.__file_name = file_name
+        if file_name:
+            self.journal = Journal(file_name, dump_note, load_note, legacy_load, note_meta)
+            self.id_sequence = Sequence(file_name + ".seq")
+        else:
+            self.journal = None
+            self.id_sequence = Sequence()
         self.restore()
 
     def add(self, note: Note) -> None:
@@ -64,7 +173,9 @@ class NoteBook(Target, UserDict):
             raise ValueError("Note is already exists!")
         note.id = self.gen_id()
         self.data[note.id] = note
-        self.__update_tag_cloud()
+        self.keys_index.add(note.id)
+        note.book = self
+        self.note_changed(note)
         self.save()
 
     def find_id(self, id: str) -> Note:
@@ -74,61 +185,150 @@ class NoteBook(Target, UserDict):
     def delete(self, id: str) -> None:
         if id not in self.data:
             raise ValueError(f"There is no note with id {id}")
-        self.data.pop(id)
-        self.__update_tag_cloud()
+        note = self.data.pop(id)
+        self.note_changing(note)
+        note.book = None
+        self.keys_index.remove(id)
+        self.unindex(id)
+        self.mark_dirty(id)
         self.save()
         return True
 
-    def __update_tag_cloud(self) -> None:
-        for note in self.data.values():
-            self.tag_cloud.update(note.tags)
+    @property
+    def tag_cloud(self):
+        # all unique tags used in notebook
+        return self.tag_stats.counts.keys()
+
+    def top_tags(self, count: int=None) -> [(str, int)]:
+        return [("#" + key, number) for key, number in self.tag_stats.top(count)]
+
+    def tags_together_with(self, tag: str, count: int=None) -> [(str, int)]:
+        return [("#" + key, number)
+                for key, number in self.tag_stats.together_with(normalize_tag(tag), count)]
 
     def gen_id(self):
-        max = 0
-        for id in self.data.keys():
-            if max < int(id):
-                max = int(id)
-        return str(max + 1)
+        # ids come from a persisted sequence, so deleted ids are never reused
+        self.last_id = self.id_sequence.next(self.last_id)
+        return str(self.last_id)
+
+
+    def note_changing(self, note: Note) -> None:
+        self.keep_base(note.id, note)
+
+    def note_changed(self, note: Note) -> None:
+        self.value_changed(note.id, note)
+
+    def fields(self, note: Note) -> tuple:
+        return note_fields(note)
+
+    def merge_fields(self, base: tuple, ours: Note, theirs: Note) -> Note:
+        return merge_note(base, ours, theirs)
+
+    def index(self, note: Note) -> None:
+        self.index_tags(note)
+        self.text_index.add(note.id, note.text)
+        self.last_id = max(self.last_id, int(note.id))
+
+    def unindex(self, id: str) -> None:
+        self.tag_stats.update(self.tag_index.terms.get(id, set()), set())
+        self.tag_index.remove(id)
+        self.text_index.remove(id)
+
+    def index_tags(self, note: Note) -> None:
+        self.index_tag_keys(note.id, note.tag_keys)
 
+    def index_tag_keys(self, id: str, tags) -> None:
+        tags = set(tags)
+        self.tag_stats.update(self.tag_index.terms.get(id, set()), tags)
+        self.tag_index.add(id, tags)
 
-    def save(self):
-        with open(self.file_name, "wb") as f:
-            dump(self, f)
+    def compacted(self) -> None:
+        self.save_text_index()
 
-    def restore(self):
+    @property
+    def text_index_file(self):
+        return self.journal.file_name + ".fts"
+
+    def save_text_index(self) -> None:
+        # the index is stored with the stamp of the snapshot it matches
+        tmp_name = self.text_index_file + ".tmp"
+        with open(tmp_name, "wb") as f:
+            dump((self.journal.snapshot_stamp(), self.text_index), f)
+            METRICS.count("text_index.bytes_written", f.tell())
+        os.replace(tmp_name, self.text_index_file)
+
+    def restore_text_index(self) -> bool:
         try:
-            with open(self.file_name, "rb") as f:
-                restored_data = load(f)
-                self.data = restored_data.data
-                self.tag_cloud = restored_data.tag_cloud
-                succsess = True
-        except:
-            self.data = {}
-            succsess = False
+            with open(self.text_index_file, "rb") as f:
+                stamp, text_index = load(f)
+                METRICS.count("text_index.bytes_read", f.tell())
+        except Exception:
+            return False
+        if stamp != self.journal.snapshot_stamp() \
+                or getattr(text_index, "version", 1) != TextIndex.VERSION:
+            return False
+        
+        # only notes changed after the snapshot need reindexing
+        for id in self.journal.log_keys:
+            note = self.data.get(id)
+            if note is None:
+                text_index.remove(id)
+            else:
+                text_index.add(id, note.text)
+        self.text_index = text_index
+        return True
+
+    def rebuild(self, records: Records) -> None:
+        self.data = records
+        self.tag_index.clear()
+        self.tag_stats.clear()
+        # tags come from the snapshot directory, notes are decoded when used
+        for id, tags in self.data.metas(note_meta):
+            self.index_tag_keys(id, tags)
+            self.last_id = max(self.last_id, int(id))
+        self.keys_index.reset(self.data)
 
-        return succsess
+        if self.journal is None or not self.restore_text_index():
+            self.text_index = TextIndex()
+            for id, note in self.data.items():
+                self.text_index.add(id, note.text)
+            if self.journal is not None:
+                try:
+                    self.save_text_index()
+                except OSError:
+                    pass
 
+    @timed()
     def find(self, tags: [str], intersec: bool=False, show_desc: bool=True) -> [Note]:
         def get_key(note: Note) -> datetime:
             return note.created
-        print(tags, intersec)
-        notes = []
-        if not tags:
-            notes
-        intersec_len = len(self.tag_cloud.intersection(tags))
-        if intersec_len == 0 or intersec_len < len(tags) and intersec:
-            return notes
-        
-        for note in self.data.values():
-            intersec_len = len(note.tags.intersection(tags))
-            if intersec_len == 0 or intersec_len < len(tags) and intersec:
-                continue
-            notes.append(note)
+        keys = {normalize_tag(tag) for tag in tags}
+        if not keys:
+            return []
+
+        if intersec:
+            ids = self.tag_index.intersection(keys)
+        else:
+            ids = self.tag_index.union(keys)
+        METRICS.observe("NoteBook.find.scanned", len(ids))
 
+        notes = [self.data[id] for id in ids]
         notes.sort(key=get_key, reverse=show_desc)
 
         return notes
     
+    @timed()
+    def search(self, query: str, count: int=None) -> [Note]:
+        # notes ranked by relevance of their text to the query
+        if METRICS.enabled:
+            postings = self.text_index.postings
+            METRICS.observe("NoteBook.search.scanned",
+                            sum(len(postings.get(term, ())) for term in set(self.text_index.tokenize(query))))
+        return [self.data[id] for score, id in self.text_index.search(query, count)]
+
+    def records_after(self, id: str = None):
+        for id in self.keys_index.after(id):
+            yield id, self.data[id]
+
     def iterator(self, records_per_page=None):
-        records = [self.data[key] for key in self.data]
-        return Pagination(records, records_per_page)
\ No newline at end of file
+        return Pagination(self.records_after, self.data.__len__, records_per_page)
\ No newline at end of file
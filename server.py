@@ -0,0 +1,107 @@
+import asyncio
+from contextlib import ExitStack
+from handler import CommandCreator
+from interfaces import UserInterface, Session
+from menu import Menu
+
+
+class NetworkUserInterface(UserInterface):
+    """
+    User interface over one client connection. Every answer is sent
+    as text lines closed by a line with a single dot, lines starting
+    with a dot get one more dot in front.
+    """
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.Menu = Menu()
+        self.reader = reader
+        self.writer = writer
+
+    async def data_input(self):
+        line = await self.reader.readline()
+        if not line:
+            return None
+        return line.decode("utf-8", errors="replace").rstrip("\r\n")
+
+    def data_output(self, data):
+        for line in str(data).split("\n"):
+            if line.startswith("."):
+                line = "." + line
+            self.writer.write(line.encode("utf-8") + b"\n")
+        self.writer.write(b".\n")
+
+
+class BotServer:
+    """
+    Line based TCP front-end, one Session per connection.
+    Commands that only read are answered right away, commands changing
+    data go through a single writer task which commits them in groups.
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 8765):
+        self.host = host
+        self.port = port
+        self.sessions = 0
+        self._writes = None
+
+    async def write_changes(self) -> None:
+        while True:
+            jobs = [await self._writes.get()]
+            while not self._writes.empty():
+                jobs.append(self._writes.get_nowait())
+
+            # all changes waiting in the queue share one flush
+            with ExitStack() as stack:
+                for target in CommandCreator.targets.loaded():
+                    stack.enter_context(target.batch())
+                for session, user_data, future in jobs:
+                    if future.cancelled():
+                        continue
+                    try:
+                        future.set_result(session.respond(user_data))
+                    except Exception as error:
+                        future.set_exception(error)
+
+    async def respond(self, session: Session, user_data: str) -> str:
+        try:
+            if session.changes_data(user_data):
+                future = asyncio.get_running_loop().create_future()
+                await self._writes.put((session, user_data, future))
+                return await future
+            return session.respond(user_data)
+        except Exception as error:
+            session.command = None
+            return f"Error: {error}"
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        ui = NetworkUserInterface(reader, writer)
+        session = Session(ui.Menu, CommandCreator())
+        self.sessions += 1
+        try:
+            ui.data_output(ui.Menu.navigate("Main"))
+            await writer.drain()
+            while not ui.Menu.close:
+                user_data = await ui.data_input()
+                if user_data is None:
+                    break
+                ui.data_output(await self.respond(session, user_data))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions -= 1
+            writer.close()
+
+    async def serve(self, started=None) -> None:
+        self._writes = asyncio.Queue()
+        writer_task = asyncio.create_task(self.write_changes())
+        server = await asyncio.start_server(self.handle_client, self.host, self.port, limit=2 ** 20)
+        if started is not None:
+            started.set_result(server.sockets[0].getsockname())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            writer_task.cancel()
+
+
+def run_server(host: str, port: int) -> None:
+    asyncio.run(BotServer(host, port).serve())
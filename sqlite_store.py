@@ -0,0 +1,467 @@
+import sqlite3
+from collections.abc import Mapping
+from contextlib import contextmanager
+from datetime import datetime
+from address_book import Target, Record, Name, Phone, Birthday, Email, Pagination, \
+    fuzzy_terms, fuzzy_search
+from notebook import Note
+from metrics import timed
+from indexes import BirthdayIndex, BKTree, TextIndex, next_birthday, normalize_key, normalize_tag
+
+
+class SqliteTarget(Target, Mapping):
+    """
+    Common part of targets kept in sqlite database.
+    Changes are written in a transaction which save() commits.
+    """
+    SCHEMA = ""
+    FTS_SCHEMA = ""
+    VERSION = 0  # PRAGMA user_version of databases this code writes
+
+    def __init__(self, file_name: str) -> None:
+        self.connection = None
+        self.fts = False  # full-text search table is available
+        self.data_version = None  # changes when another connection commits
+        self._batch_depth = 0
+        self.__file_name = None
+        self.file_name = file_name
+
+    @property
+    def file_name(self):
+        return self.__file_name
+
+    @file_name.setter
+    def file_name(self, file_name: str):
+        self.__file_name = file_name
+        self.restore()
+
+    def execute(self, query: str, params=()):
+        return self.connection.execute(query, params)
+
+    @timed()
+    def restore(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = sqlite3.connect(self.file_name, check_same_thread=False)
+        self.execute("PRAGMA journal_mode=WAL")
+        self.execute("PRAGMA synchronous=NORMAL")
+        self.execute("PRAGMA foreign_keys=ON")
+        self.connection.executescript(self.SCHEMA)
+        try:
+            self.connection.executescript(self.FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            # sqlite built without FTS5, searches fall back to scanning
+            self.fts = False
+        self.migrate()
+        self.data_version = self.execute("PRAGMA data_version").fetchone()[0]
+        return True
+
+    def refresh(self) -> bool:
+        """
+        Sqlite locks the database itself, only data kept in memory may
+        get old. True if another process has committed since the last call
+        """
+        version = self.execute("PRAGMA data_version").fetchone()[0]
+        if version == self.data_version:
+            return False
+        self.data_version = version
+        return True
+
+    def migrate(self) -> None:
+        """Brings databases written by older versions up to VERSION"""
+        version = self.execute("PRAGMA user_version").fetchone()[0]
+        if version < self.VERSION:
+            self.upgrade(version)
+            self.execute(f"PRAGMA user_version = {self.VERSION}")
+            self.connection.commit()
+
+    def upgrade(self, version: int) -> None:
+        pass
+
+    def add_column(self, table: str, column: str) -> None:
+        if column not in {row[1] for row in self.execute(f"PRAGMA table_info({table})")}:
+            self.execute(f"ALTER TABLE {table} ADD COLUMN {column} TEXT")
+
+    @timed()
+    def save(self):
+        if not self._batch_depth:
+            self.connection.commit()
+
+    @contextmanager
+    def batch(self):
+        """All changes inside share one transaction"""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.connection.commit()
+
+    def iterator(self, records_per_page=None):
+        return Pagination(self.records_after, self.__len__, records_per_page)
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+class BirthdayQuery(BirthdayIndex):
+    """
+    BirthdayIndex whose day ranges are read from the contacts table
+    """
+    def __init__(self, connection):
+        super().__init__()
+        self.connection = connection
+
+    def range(self, first: int, last: int) -> list:
+        return self.connection.execute(
+            "SELECT birthday_day, name FROM contacts "
+            "WHERE birthday_day BETWEEN ? AND ? ORDER BY birthday_day, name",
+            (first, last)).fetchall()
+
+
+class SqliteAddressBook(SqliteTarget):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS contacts (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            birthday TEXT,
+            birthday_day INTEGER,
+            email TEXT,
+            email_lower TEXT,
+            name_key TEXT,
+            search_key TEXT
+        );
+        CREATE TABLE IF NOT EXISTS phones (
+            contact_id INTEGER NOT NULL REFERENCES contacts(id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            phone TEXT NOT NULL,
+            PRIMARY KEY (contact_id, position)
+        );
+        CREATE INDEX IF NOT EXISTS phones_phone ON phones(phone);
+        CREATE INDEX IF NOT EXISTS contacts_email ON contacts(email_lower);
+        CREATE INDEX IF NOT EXISTS contacts_birthday ON contacts(birthday_day);
+        """
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS contacts_search
+            USING fts5(text, tokenize='trigram case_sensitive 1');
+        """
+    VERSION = 1
+
+    def __init__(self, file_name: str, unique_phones: bool = False) -> None:
+        self.unique_phones = unique_phones
+        self.fuzzy_index = None  # built from names on first fuzzy search
+        super().__init__(file_name)
+
+    def restore(self):
+        self.fuzzy_index = None
+        super().restore()
+
+    def refresh(self) -> bool:
+        if super().refresh():
+            self.fuzzy_index = None
+            return True
+        return False
+
+    def upgrade(self, version: int) -> None:
+        # version 1: normalized keys of names and search texts
+        self.add_column("contacts", "name_key")
+        self.add_column("contacts", "search_key")
+        self.execute("CREATE INDEX IF NOT EXISTS contacts_name_key ON contacts(name_key)")
+        for name, in self.execute("SELECT name FROM contacts").fetchall():
+            self.write(self[name])
+
+    def _contact_id(self, name: str, exact: bool = False) -> int:
+        """
+        Id of the contact with the name or, unless exact,
+        of the only contact with the same normalized name
+        """
+        row = self.execute("SELECT id FROM contacts WHERE name = ?", (name,)).fetchone()
+        if row or exact:
+            return row[0] if row else None
+        rows = self.execute("SELECT id FROM contacts WHERE name_key = ? LIMIT 2",
+                            (normalize_key(name),)).fetchall()
+        return rows[0][0] if len(rows) == 1 else None
+
+    def __getitem__(self, name: str) -> Record:
+        id = self._contact_id(name)
+        if id is None:
+            raise KeyError(name)
+        name, birthday, email = self.execute("SELECT name, birthday, email FROM contacts WHERE id = ?",
+                                             (id,)).fetchone()
+        record = Record.__new__(Record)
+        record.book = self
+        record.name = Name.from_value(name, True)
+        record.phones = [Phone.from_value(phone) for phone, in self.execute(
+            "SELECT phone FROM phones WHERE contact_id = ? ORDER BY position", (id,))]
+        record.birthday = None
+        if birthday:
+            value = Birthday.parse(birthday)
+            record.birthday = Birthday.from_value(value)
+        record.email = Email.from_value(email) if email else None
+        return record
+
+    def __contains__(self, name) -> bool:
+        return self._contact_id(name) is not None
+
+    def __len__(self) -> int:
+        return self.execute("SELECT COUNT(*) FROM contacts").fetchone()[0]
+
+    def __iter__(self):
+        for name, in self.execute("SELECT name FROM contacts ORDER BY name"):
+            yield name
+
+    def records_after(self, name: str = None):
+        for name, in self.execute("SELECT name FROM contacts WHERE name > ? ORDER BY name",
+                                  (name or "",)):
+            yield name, self[name]
+
+    def write(self, record: Record) -> None:
+        name = record.name.value
+        birthday = record.birthday.value if record.birthday else None
+        search_key = record.search_key()
+        values = (
+                str(record.birthday) if birthday else None,
+                BirthdayIndex.day_of_year(birthday.month, birthday.day) if birthday else None,
+                record.email.value if record.email else None,
+                normalize_key(record.email.value) if record.email else None,
+                normalize_key(name),
+                search_key,
+                )
+        id = self._contact_id(name, exact=True)
+        if id is None:
+            id = self.execute("INSERT INTO contacts (birthday, birthday_day, email, email_lower, "
+                              "name_key, search_key, name) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              values + (name,)).lastrowid
+            if self.fuzzy_index is not None:
+                self.fuzzy_index.add(name, fuzzy_terms(name))
+        else:
+            self.execute("UPDATE contacts SET birthday = ?, birthday_day = ?, email = ?, "
+                         "email_lower = ?, name_key = ?, search_key = ? WHERE id = ?", values + (id,))
+            self.execute("DELETE FROM phones WHERE contact_id = ?", (id,))
+        self.connection.executemany(
+            "INSERT INTO phones (contact_id, position, phone) VALUES (?, ?, ?)",
+            [(id, position, phone.value) for position, phone in enumerate(record.phones)])
+        if self.fts:
+            self.execute("DELETE FROM contacts_search WHERE rowid = ?", (id,))
+            self.execute("INSERT INTO contacts_search (rowid, text) VALUES (?, ?)", (id, search_key))
+
+    def add(self, record: Record) -> None:
+        if self.execute("SELECT 1 FROM contacts WHERE name = ? OR name_key = ?",
+                        (record.name.value, normalize_key(record.name.value))).fetchone():
+            raise ValueError(f"Record with name {record.name.value} is already exists")
+        self.check_phones(record.name.value, [p.value for p in record.phones])
+        self.write(record)
+        record.book = self
+        self.save()
+
+    def delete(self, name: str) -> bool:
+        id = self._contact_id(name)
+        if id is None:
+            return None
+        self.execute("DELETE FROM contacts WHERE id = ?", (id,))
+        if self.fts:
+            self.execute("DELETE FROM contacts_search WHERE rowid = ?", (id,))
+        if self.fuzzy_index is not None:
+            self.fuzzy_index.remove(name)
+        self.save()
+        return True
+
+    def record_changing(self, record: Record) -> None:
+        # every change is written at once, there is nothing to merge later
+        pass
+
+    def record_changed(self, record: Record) -> None:
+        self.write(record)
+
+    def check_phones(self, name: str, phones: [str]) -> None:
+        if not self.unique_phones:
+            return
+        for phone in phones:
+            row = self.execute("SELECT c.name FROM phones p JOIN contacts c ON c.id = p.contact_id "
+                               "WHERE p.phone = ? AND c.name != ? LIMIT 1", (phone, name)).fetchone()
+            if row:
+                raise ValueError(f"{phone} already belongs to {row[0]}")
+
+    def find(self, search: str) -> [Record]:
+        return [self[name] for name in self.find_names(search)]
+
+    @timed()
+    def find_names(self, search: str) -> [str]:
+        search = normalize_key(search)
+        if self.fts and len(search) >= 3:
+            # trigram index gives candidates, search_key checks them
+            names = self.execute(
+                "SELECT c.name FROM contacts_search s JOIN contacts c ON c.id = s.rowid "
+                "WHERE contacts_search MATCH ? AND instr(c.search_key, ?) ORDER BY c.name",
+                ('"' + search.replace('"', '""') + '"', search))
+        else:
+            names = self.execute("SELECT name FROM contacts WHERE instr(search_key, ?) ORDER BY name",
+                                 (search,))
+        return [name for name, in names.fetchall()]
+
+    def find_fuzzy(self, search: str, max_distance: int = None) -> [Record]:
+        if self.fuzzy_index is None:
+            self.fuzzy_index = BKTree()
+            for name, in self.execute("SELECT name FROM contacts"):
+                self.fuzzy_index.add(name, fuzzy_terms(name))
+        return [self[name] for typos, name in fuzzy_search(self.fuzzy_index, search, max_distance)]
+
+    def find_by_phone(self, phone: str) -> [Record]:
+        names = self.execute("SELECT c.name FROM phones p JOIN contacts c ON c.id = p.contact_id "
+                             "WHERE p.phone = ?", (phone,)).fetchall()
+        return [self[name] for name, in names]
+
+    def find_by_email(self, email: str) -> [Record]:
+        names = self.execute("SELECT name FROM contacts WHERE email_lower = ?",
+                             (normalize_key(email),)).fetchall()
+        return [self[name] for name, in names]
+
+    def upcoming_birthdays(self, days: int, today=None) -> [(int, Record)]:
+        today = today if today else datetime.now().date()
+        upcoming = BirthdayQuery(self.connection).upcoming(today, days)
+        upcoming.sort()
+        return [(days_left, self[name]) for days_left, name in upcoming]
+
+    def days_to_birthday(self, name: str, today=None) -> int:
+        id = self._contact_id(name)
+        if id is None:
+            raise KeyError(name)
+        row = self.execute("SELECT birthday_day FROM contacts WHERE id = ?", (id,)).fetchone()
+        if row[0] is None:
+            return None
+        today = today if today else datetime.now().date()
+        birthday = next_birthday(*BirthdayIndex.month_day(row[0]), today)
+        return (birthday - today).days
+
+
+class SqliteNoteBook(SqliteTarget):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS notes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created TEXT NOT NULL,
+            text TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS note_tags (
+            note_id INTEGER NOT NULL REFERENCES notes(id) ON DELETE CASCADE,
+            tag TEXT NOT NULL,
+            tag_key TEXT,
+            PRIMARY KEY (tag, note_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS note_tags_note ON note_tags(note_id);
+        """
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_search USING fts5(text);
+        """
+    VERSION = 1
+
+    def upgrade(self, version: int) -> None:
+        # version 1: normalized tags
+        self.add_column("note_tags", "tag_key")
+        self.execute("CREATE INDEX IF NOT EXISTS note_tags_key ON note_tags(tag_key, note_id)")
+        for tag, in self.execute("SELECT DISTINCT tag FROM note_tags").fetchall():
+            self.execute("UPDATE note_tags SET tag_key = ? WHERE tag = ?", (normalize_tag(tag), tag))
+
+    def __getitem__(self, id: str) -> Note:
+        if not str(id).isdigit():
+            raise KeyError(id)
+        row = self.execute("SELECT created, text FROM notes WHERE id = ?", (int(id),)).fetchone()
+        if row is None:
+            raise KeyError(id)
+        tags = [tag for tag, in self.execute("SELECT tag FROM note_tags WHERE note_id = ?", (int(id),))]
+        note = Note.from_dict({"id": str(id), "created": row[0], "text": row[1], "tags": tags})
+        note.book = self
+        return note
+
+    def __contains__(self, id) -> bool:
+        if not str(id).isdigit():
+            return False
+        return self.execute("SELECT 1 FROM notes WHERE id = ?", (int(id),)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+
+    def __iter__(self):
+        for id, in self.execute("SELECT id FROM notes ORDER BY id"):
+            yield str(id)
+
+    def records_after(self, id: str = None):
+        for id, in self.execute("SELECT id FROM notes WHERE id > ? ORDER BY id", (int(id or 0),)):
+            yield str(id), self[id]
+
+    def write(self, note: Note) -> None:
+        id = int(note.id)
+        self.execute("UPDATE notes SET text = ? WHERE id = ?", (note.text, id))
+        self.execute("DELETE FROM note_tags WHERE note_id = ?", (id,))
+        self.connection.executemany("INSERT INTO note_tags (note_id, tag, tag_key) VALUES (?, ?, ?)",
+                                    [(id, tag, normalize_tag(tag)) for tag in note.tags])
+        if self.fts:
+            self.execute("DELETE FROM notes_search WHERE rowid = ?", (id,))
+            self.execute("INSERT INTO notes_search (rowid, text) VALUES (?, ?)", (id, note.text))
+
+    def add(self, note: Note) -> None:
+        if note.id is not None and note.id in self:
+            raise ValueError("Note is already exists!")
+        # AUTOINCREMENT never gives out ids of deleted notes again
+        note.id = str(self.execute("INSERT INTO notes (created, text) VALUES (?, ?)",
+                                   (note.created.isoformat(), note.text)).lastrowid)
+        self.write(note)
+        note.book = self
+        self.save()
+
+    def delete(self, id: str) -> None:
+        if id not in self:
+            raise ValueError(f"There is no note with id {id}")
+        self.execute("DELETE FROM notes WHERE id = ?", (int(id),))
+        if self.fts:
+            self.execute("DELETE FROM notes_search WHERE rowid = ?", (int(id),))
+        self.save()
+        return True
+
+    def note_changing(self, note: Note) -> None:
+        # every change is written at once, there is nothing to merge later
+        pass
+
+    def note_changed(self, note: Note) -> None:
+        self.write(note)
+
+    @timed()
+    def find(self, tags: [str], intersec: bool=False, show_desc: bool=True) -> [Note]:
+        tags = list({normalize_tag(tag) for tag in tags})
+        if not tags:
+            return []
+        marks = ", ".join("?" * len(tags))
+        query = f"SELECT n.id FROM notes n WHERE n.id IN (SELECT note_id FROM note_tags " \
+                f"WHERE tag_key IN ({marks}) GROUP BY note_id"
+        if intersec:
+            query += f" HAVING COUNT(*) = {len(tags)}"
+        query += ") ORDER BY n.created " + ("DESC" if show_desc else "ASC")
+        return [self[id] for id, in self.execute(query, tags).fetchall()]
+
+    @timed()
+    def search(self, query: str, count: int=None) -> [Note]:
+        words = TextIndex.tokenize(query)
+        if not words:
+            return []
+        if self.fts:
+            match = " OR ".join('"' + word.replace('"', '""') + '"' for word in words)
+            ids = self.execute("SELECT rowid FROM notes_search WHERE notes_search MATCH ? "
+                               "ORDER BY bm25(notes_search) LIMIT ?",
+                               (match, count if count else -1)).fetchall()
+        else:
+            condition = " OR ".join("text LIKE ?" for word in words)
+            ids = self.execute(f"SELECT id FROM notes WHERE {condition} LIMIT ?",
+                               [f"%{word}%" for word in words] + [count if count else -1]).fetchall()
+        return [self[id] for id, in ids]
+
+    def top_tags(self, count: int=None) -> [(str, int)]:
+        return self.execute("SELECT '#' || tag_key, COUNT(*) FROM note_tags GROUP BY tag_key "
+                            "ORDER BY COUNT(*) DESC, tag_key LIMIT ?", (count if count else -1,)).fetchall()
+
+    def tags_together_with(self, tag: str, count: int=None) -> [(str, int)]:
+        return self.execute("SELECT '#' || b.tag_key, COUNT(*) FROM note_tags a JOIN note_tags b "
+                            "ON b.note_id = a.note_id AND b.tag_key != a.tag_key WHERE a.tag_key = ? "
+                            "GROUP BY b.tag_key ORDER BY COUNT(*) DESC, b.tag_key LIMIT ?",
+                            (normalize_tag(tag), count if count else -1)).fetchall()
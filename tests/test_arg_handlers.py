@@ -0,0 +1,15 @@
+from arg_handlers import Validator
+
+
+def test_validate_many_gives_errors_of_every_record():
+    results = Validator().validate_many([
+            {"name": "Bob", "phone": ["0501234567"], "email": ""},
+            {"name": "Ann", "phone": ["12", "0501234567"], "email": "ann"},
+            {"name": "Eve", "email": "eve@x.com"},
+            ], optional=("email",))
+    assert len(results) == 3
+    values, errors = results[0]
+    assert errors == {} and values["name"].value == "Bob" and "email" not in values
+    values, errors = results[1]
+    assert set(errors) == {"phone", "email"} and values["name"].value == "Ann"
+    assert results[2][1] == {}
@@ -0,0 +1,41 @@
+import os
+
+from file_sorter import DuplicateFinder, HashCache
+
+
+def make_folder(folder, name: str, pairs: int = 6) -> str:
+    path = folder / name
+    path.mkdir()
+    for i in range(pairs):
+        for copy in range(2):
+            (path / f"{i}-{copy}.txt").write_text(f"{name} file {i:04}")
+    return str(path)
+
+
+def run(root: str, cache_name: str) -> int:
+    cache = HashCache(cache_name)
+    report = DuplicateFinder(root, 1, cache=cache).run()
+    cache.close()
+    return report.hashed
+
+
+def test_scanning_another_folder_keeps_cached_hashes(tmp_path):
+    # more than half of the cache is outside the second folder
+    first = make_folder(tmp_path, "a", 8)
+    second = make_folder(tmp_path, "b", 4)
+    cache_name = str(tmp_path / "hashes.bin")
+    assert run(first, cache_name) == 16
+    assert run(second, cache_name) == 8
+    assert run(first, cache_name) == 0
+
+
+def test_files_gone_from_the_scanned_folder_are_dropped(tmp_path):
+    folder = make_folder(tmp_path, "a")
+    cache_name = str(tmp_path / "hashes.bin")
+    run(folder, cache_name)
+    for name in os.listdir(folder)[:8]:
+        os.remove(os.path.join(folder, name))
+    run(folder, cache_name)
+    cache = HashCache(cache_name)
+    assert len(cache.data) < 12
+    assert all(not cache.missing(key) for key in cache.data)
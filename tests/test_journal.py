@@ -0,0 +1,130 @@
+import os
+import threading
+
+import pytest
+
+from address_book import AddressBook, Record, Name, Email
+from journal import Journal, Records, CorruptedFile, LOG_MAGIC
+
+
+def journal(tmp_path) -> Journal:
+    return Journal(str(tmp_path / "data.bin"))
+
+
+def test_log_is_replayed_over_the_snapshot(tmp_path):
+    writer = journal(tmp_path)
+    writer.load()
+    writer.append("a", 1)
+    writer.append("b", 2)
+    writer.lock()
+    writer.snapshot({"a": 1, "b": 2})
+    writer.unlock()
+    writer.append("b", None)
+    writer.append("c", 3)
+    assert dict(journal(tmp_path).load()) == {"a": 1, "c": 3}
+
+
+def test_torn_tail_is_dropped_under_the_lock(tmp_path):
+    writer = journal(tmp_path)
+    writer.load()
+    writer.append("a", 1)
+    size = os.path.getsize(writer.log_name)
+    with open(writer.log_name, "ab") as f:
+        f.write(writer._frame("b", 2)[:-3])
+    reader = journal(tmp_path)
+    assert dict(reader.load()) == {"a": 1}
+    reader.append("c", 3)
+    assert os.path.getsize(reader.log_name) > size
+    assert dict(journal(tmp_path).load()) == {"a": 1, "c": 3}
+
+
+def test_damaged_entry_raises(tmp_path):
+    writer = journal(tmp_path)
+    writer.load()
+    writer.append("a", "value")
+    writer.append("b", "value")
+    with open(writer.log_name, "r+b") as f:
+        f.seek(len(LOG_MAGIC) + 14)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 0xFF]))
+    with pytest.raises(CorruptedFile):
+        journal(tmp_path).load()
+
+
+def test_changes_of_another_process(tmp_path):
+    first, second = journal(tmp_path), journal(tmp_path)
+    first.load()
+    second.load()
+    first.append("a", 1)
+    assert second.changes() == {"a": 1}
+    assert second.changes() == {}
+    first.lock()
+    first.snapshot({"a": 1})
+    first.unlock()
+    assert second.changes() is None
+
+
+def wait_in_thread(call) -> (threading.Thread, list):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(call()))
+    thread.start()
+    thread.join(0.2)
+    return thread, result
+
+
+def test_lock_waits_for_the_writer(tmp_path):
+    first, second = journal(tmp_path), journal(tmp_path)
+    first.load()
+    second.load()
+    with first.batch():
+        first.append("a", 1)
+        thread, result = wait_in_thread(second.lock)
+        assert thread.is_alive()
+    thread.join(5)
+    assert result == [{"a": 1}]
+    second.unlock()
+
+
+def test_reader_waits_for_a_compaction(tmp_path):
+    first, second = journal(tmp_path), journal(tmp_path)
+    first.load()
+    second.load()
+    first.append("a", 1)
+    first.lock()
+    thread, result = wait_in_thread(second.changes)
+    assert thread.is_alive()
+    first.snapshot({"a": 1})
+    first.unlock()
+    thread.join(5)
+    assert result == [None]
+    assert dict(second.load()) == {"a": 1}
+
+
+def test_decoded_records_are_not_all_kept(tmp_path, monkeypatch):
+    monkeypatch.setattr(Records, "CACHE_SIZE", 10)
+    writer = journal(tmp_path)
+    writer.load()
+    writer.lock()
+    writer.snapshot({str(i): i for i in range(50)})
+    writer.unlock()
+    records = journal(tmp_path).load()
+    assert sum(records[key] for key in records) == sum(range(50))
+    assert len(records.cache) == 10 and not records.loaded
+
+
+def test_change_of_a_dropped_record_is_saved(tmp_path, monkeypatch):
+    monkeypatch.setattr(Records, "CACHE_SIZE", 2)
+    file_name = str(tmp_path / "book.bin")
+    book = AddressBook(file_name)
+    for i in range(5):
+        book.add(Record(Name(f"Bob{i}")))
+    book.compact()
+    book = AddressBook(file_name)
+    record = book["Bob0"]
+    for i in range(1, 5):
+        book[f"Bob{i}"]
+    assert "Bob0" not in book.data.cache
+    record.add_email(Email("bob@x.com"))
+    book.save()
+    assert AddressBook(file_name)["Bob0"].email.value == "bob@x.com"
@@ -0,0 +1,145 @@
+import pytest
+
+from address_book import AddressBook, Record, Name, Phone, Email, Birthday, merge_record, record_fields
+from journal import merge_change
+from notebook import NoteBook, Note, merge_note, note_fields
+
+
+def contact(name="Bob", phones=(), email=None, birthday=None) -> Record:
+    record = Record(Name(name), birthday=Birthday(birthday) if birthday else None,
+                    email=Email(email) if email else None)
+    for phone in phones:
+        record.add_phone(Phone(phone))
+    return record
+
+
+def phones(record: Record) -> list:
+    return sorted(p.value for p in record.phones)
+
+
+def test_merge_change_deleted_on_both_sides():
+    base = record_fields(contact(phones=["0501111111"]))
+    assert merge_change(base, None, None, record_fields, merge_record) is None
+    note_base = note_fields(Note("text", ["a"]))
+    assert merge_change(note_base, None, None, note_fields, merge_note) is None
+
+
+def test_merge_change_deletion_stands_if_other_side_kept_the_value():
+    record = contact(phones=["0501111111"])
+    base = record_fields(record)
+    assert merge_change(base, None, record, record_fields, merge_record) is None
+    assert merge_change(base, record, None, record_fields, merge_record) is None
+
+
+def test_merge_change_deleted_and_changed_is_a_conflict():
+    base = record_fields(contact(phones=["0501111111"]))
+    changed = contact(phones=["0501111111", "0502222222"])
+    with pytest.raises(ValueError):
+        merge_change(base, None, changed, record_fields, merge_record)
+    with pytest.raises(ValueError):
+        merge_change(base, changed, None, record_fields, merge_record)
+
+
+def test_merge_change_keeps_a_value_added_here():
+    ours = contact()
+    assert merge_change(None, ours, None, record_fields, merge_record) is ours
+
+
+def test_merge_record_takes_each_field_from_the_side_that_changed_it():
+    base = record_fields(contact(phones=["0501111111", "0502222222"]))
+    ours = contact(phones=["0501111111", "0503333333"], birthday="01.02.1990")
+    theirs = contact(phones=["0501111111", "0502222222", "0504444444"], email="bob@x.com")
+    merged = merge_record(base, ours, theirs)
+    assert phones(merged) == ["0501111111", "0503333333", "0504444444"]
+    assert merged.email.value == "bob@x.com"
+    assert str(merged.birthday) == "01.02.1990"
+
+
+def test_merge_record_same_change_on_both_sides():
+    base = record_fields(contact())
+    merged = merge_record(base, contact(email="a@x.com"), contact(email="a@x.com"))
+    assert merged.email.value == "a@x.com"
+
+
+def test_merge_record_conflicting_field():
+    base = record_fields(contact(email="a@x.com"))
+    with pytest.raises(ValueError):
+        merge_record(base, contact(email="b@x.com"), contact(email="c@x.com"))
+
+
+def test_merge_note_text_and_tags():
+    base = note_fields(Note("hello", ["a", "b"]))
+    ours = Note("hello", ["b", "c"])
+    theirs = Note("hello world", ["a", "b", "d"])
+    merged = merge_note(base, ours, theirs)
+    assert merged.text == "hello world"
+    assert sorted(merged.tags) == ["#b", "#c", "#d"]
+
+
+def test_merge_note_conflicting_text():
+    base = note_fields(Note("hello", []))
+    with pytest.raises(ValueError):
+        merge_note(base, Note("one", []), Note("two", []))
+
+
+def test_books_merge_edits_of_another_process(tmp_path):
+    file_name = str(tmp_path / "book.bin")
+    first = AddressBook(file_name)
+    first.add(contact(phones=["0501111111"]))
+    second = AddressBook(file_name)
+    held = second["Bob"]
+    first["Bob"].add_email(Email("bob@x.com"))
+    first.save()
+    held.add_phone(Phone("0509999999"))
+    second.save()
+    stored = AddressBook(file_name)["Bob"]
+    assert phones(stored) == ["0501111111", "0509999999"]
+    assert stored.email.value == "bob@x.com"
+
+
+def test_books_report_a_deleted_contact_edited_here(tmp_path):
+    file_name = str(tmp_path / "book.bin")
+    first = AddressBook(file_name)
+    first.add(contact(phones=["0501111111"]))
+    second = AddressBook(file_name)
+    held = second["Bob"]
+    first.delete("Bob")
+    held.add_phone(Phone("0509999999"))
+    with pytest.raises(ValueError, match="another process"):
+        second.save()
+    assert "Bob" not in second
+    assert "Bob" not in AddressBook(file_name)
+
+
+@pytest.mark.parametrize("kind", ["contacts", "notes"])
+def test_books_delete_the_same_key(tmp_path, kind):
+    file_name = str(tmp_path / "book.bin")
+    if kind == "contacts":
+        first = AddressBook(file_name)
+        first.add(contact())
+        key = "Bob"
+        second = AddressBook(file_name)
+    else:
+        first = NoteBook(file_name)
+        first.add(Note("hello", ["a"]))
+        key = next(iter(first.data))
+        second = NoteBook(file_name)
+    first.delete(key)
+    second.delete(key)
+    second.refresh()
+    assert key not in second
+
+
+@pytest.mark.parametrize("kind", ["contacts", "notes"])
+def test_restore_forgets_changes_not_saved(tmp_path, kind):
+    if kind == "contacts":
+        book = AddressBook(str(tmp_path / "book.bin"))
+        book.add(contact())
+        book["Bob"].add_email(Email("bob@x.com"))
+    else:
+        book = NoteBook(str(tmp_path / "book.bin"))
+        book.add(Note("hello", ["a"]))
+        book[next(iter(book.data))].edit_text("changed")
+    assert book._dirty and book._base
+    book.restore()
+    assert not book._dirty and not book._base
@@ -0,0 +1,14 @@
+from address_book import Pagination
+
+
+def test_from_keys_skips_keys_deleted_meanwhile():
+    records = {"a": "A", "b": "B", "c": "C"}
+    pagination = Pagination.from_keys(list(records), records.get, 2)
+    assert next(pagination).splitlines()[:2] == ["A", "B"]
+    del records["c"]
+    try:
+        next(pagination)
+    except StopIteration:
+        pass
+    else:
+        raise AssertionError("a deleted key was shown")